@@ -11,17 +11,113 @@ RETURNS STRING
 LANGUAGE PYTHON
 COMMENT 'Extract metrics from a Databricks dashboard using LLM analysis and generate multiple CREATE METRIC VIEW SQL statements with execution order.'
 AS $$
+import copy
+import dataclasses
 import json
 import re
+import sys
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from urllib3.util import Retry
+from typing import Optional
 from databricks.sdk import WorkspaceClient
 
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib json module
+    orjson = None
+
 DATABRICKS_HOST = "https://<your-workspace>.cloud.databricks.com"
 LLM_MODEL = "databricks-claude-opus-4-5"
 
+# Dashboard analysis is split into requests of at most ANALYSIS_BATCH_SIZE datasets, sent concurrently
+ANALYSIS_BATCH_SIZE = 4
+ANALYSIS_MAX_WORKERS = 8
+
+# Shared HTTP session: keeps connections alive across LLM calls and retries
+# rate-limited (429) and transient 5xx responses with exponential backoff.
+# read=0: a request that reached the endpoint is never re-sent after a read
+# error or timeout, which would re-bill a long generation
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=3,
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False
+    )
+))
+
+# Precompiled regular expressions
+_MULTI_UNDERSCORE_RE = re.compile(r'_+')
+# Filter datasets typically use explode(array(...)) to create dropdown options
+_FILTER_DATASET_RE = re.compile(r'explode\s*\(\s*array\s*\(', re.IGNORECASE)
+# MEASURE(name) references inside derived measure expressions
+_MEASURE_REF_RE = re.compile(r'MEASURE\((\w+)\)')
+
+
+class _NameTranslationTable(dict):
+    """str.translate table mapping every character outside [a-zA-Z0-9_] to '_'.
+    
+    ASCII is precomputed; any other code point falls through to __missing__.
+    """
+    def __missing__(self, codepoint):
+        return '_'
+
+
+_NAME_TABLE = _NameTranslationTable(
+    (i, chr(i) if chr(i).isalnum() or chr(i) == '_' else '_') for i in range(128)
+)
+
 
-def call_foundation_model(prompt, pat_token):
-    """Call Databricks Foundation Model API with Claude Opus 4.5."""
+def _json_loads(data):
+    """Parse JSON from str or bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps_compact(obj):
+    """Serialize to compact JSON (no whitespace, non-ASCII kept), using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+
+def _json_dumps_bytes(obj):
+    """Serialize to compact UTF-8 JSON bytes for a request body, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _extract_json(text, opener='{'):
+    """Decode the first JSON value starting with opener ('{' or '[') embedded in text; raises JSONDecodeError if none."""
+    stripped = text.strip()
+    if orjson is not None and stripped.startswith(opener):
+        try:
+            return orjson.loads(stripped)
+        except orjson.JSONDecodeError:
+            pass
+    i = text.find(opener)
+    while i != -1:
+        try:
+            return _JSON_DECODER.raw_decode(text, i)[0]
+        except json.JSONDecodeError:
+            i = text.find(opener, i + 1)
+    return json.loads(text)
+
+
+def call_foundation_model(prompt, pat_token, system_prompt=None):
+    """Call Databricks Foundation Model API with Claude Opus 4.5 (system_prompt is sent as a cached block)."""
     url = f"{DATABRICKS_HOST}/serving-endpoints/{LLM_MODEL}/invocations"
     
     headers = {
@@ -31,94 +127,82 @@ def call_foundation_model(prompt, pat_token):
     
     payload = {
         "messages": [
-            {"role": "user", "content": prompt}
+            {"role": "user", "content": [{"type": "text", "text": prompt}]}
         ],
         "max_tokens": 32000
     }
+    if system_prompt:
+        payload["system"] = [
+            {"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}
+        ]
     
-    response = requests.post(url, headers=headers, json=payload, timeout=120)
+    # Encode the body once ourselves; json= would re-serialize it with stdlib json
+    response = _SESSION.post(url, headers=headers, data=_json_dumps_bytes(payload), timeout=120)
     response.raise_for_status()
     
-    result = response.json()
+    result = _json_loads(response.content)
     # Extract content from response
-    if "choices" in result and len(result["choices"]) > 0:
-        return result["choices"][0]["message"]["content"]
-    return result.get("content", str(result))
+    try:
+        choice = result["choices"][0]
+    except (KeyError, IndexError):
+        return result.get("content", str(result))
+    return choice["message"]["content"]
 
 
 def is_filter_dataset(query):
     """Check if a dataset is a filter/toggle dataset (uses explode(array(...)))."""
-    if not query:
-        return False
-    query_lower = query.lower()
-    # Filter datasets typically use explode(array(...)) to create dropdown options
-    return 'explode(array(' in query_lower or 'explode (array(' in query_lower
+    # Case-insensitive search avoids lowercasing a copy of the whole query
+    return bool(query and _FILTER_DATASET_RE.search(query))
 
 
 def extract_widget_fields(dashboard_json):
-    """Extract fields used in widget visualizations, including widget titles."""
-    widget_fields = []
-    for page in dashboard_json.get('pages', []):
-        for layout_item in page.get('layout', []):
-            widget = layout_item.get('widget', {})
-            widget_title = widget.get('name', '')  # Widget title for measure naming
-            for query in widget.get('queries', []):
-                query_obj = query.get('query', {})
-                dataset_name = query_obj.get('datasetName', '')
-                for field in query_obj.get('fields', []):
-                    widget_fields.append({
-                        'dataset': dataset_name,
-                        'widget_title': widget_title,  # Include widget title
-                        'name': field.get('name', ''),
-                        'expression': field.get('expression', '')
-                    })
-    return widget_fields
-
-
-def build_analysis_prompt(dashboard_json, target_catalog_schema):
-    """Build the prompt for LLM to analyze dashboard structure."""
+    """Extract fields used in widget visualizations, including widget titles (empty and duplicate fields skipped)."""
+    # Single flat generator; empty tuples as defaults avoid allocating on misses
+    fields = (
+        (
+            query_obj.get('datasetName', ''),
+            widget.get('name', ''),  # Widget title for measure naming
+            field
+        )
+        for page in dashboard_json.get('pages', ())
+        for layout_item in page.get('layout', ())
+        for widget in (layout_item.get('widget', {}),)
+        for query in widget.get('queries', ())
+        for query_obj in (query.get('query', {}),)
+        for field in query_obj.get('fields', ())
+    )
     
-    # Extract datasets info for the prompt, filtering out filter/toggle datasets
-    datasets_info = []
-    skipped_count = 0
-    for dataset in dashboard_json.get('datasets', []):
-        query = ''.join(dataset.get('queryLines', []))
-        
-        # Skip filter/toggle datasets that use explode(array(...))
-        if is_filter_dataset(query):
-            skipped_count += 1
+    widget_fields = []
+    seen = set()
+    for dataset_name, widget_title, field in fields:
+        # Fields almost always carry both keys; only fall back to .get() when not
+        try:
+            name = field['name']
+            expression = field['expression']
+        except KeyError:
+            name = field.get('name', '')
+            expression = field.get('expression', '')
+        # Skip empty placeholder fields and repeats of the same field
+        if not name and not expression:
             continue
-        
-        ds_info = {
-            'name': dataset.get('name', ''),
-            'displayName': dataset.get('displayName', ''),
-            'queryLines': query,
-            'columns': dataset.get('columns', [])
-        }
-        datasets_info.append(ds_info)
-    
-    # Extract widget fields to identify what's actually being used
-    widget_fields = extract_widget_fields(dashboard_json)
-    
-    prompt = f"""Analyze this Databricks dashboard using a MEASURE-FIRST approach.
-
-## Widget Fields (what's actually visualized)
-
-These are the fields used in dashboard widgets. Each field includes:
-- `widget_title`: The title of the widget (use this as the measure name when available)
-- `expression`: The field expression (look for aggregate functions to identify measures)
-
-```json
-{json.dumps(widget_fields, indent=2)}
-```
+        key = (dataset_name, name, expression)
+        if key in seen:
+            continue
+        seen.add(key)
+        widget_fields.append({
+            'dataset': dataset_name,
+            'widget_title': widget_title,
+            'name': name,
+            'expression': expression
+        })
+    return widget_fields
 
-## Dashboard Datasets
 
-Note: {len(datasets_info)} data datasets found ({skipped_count} filter/toggle datasets were pre-filtered).
+# Static instructions for the dashboard analysis call. Sent as a cached system
+# block, so this text must stay byte-identical between calls.
+ANALYSIS_INSTRUCTIONS = """Analyze the Databricks dashboard datasets provided in the user message using a MEASURE-FIRST approach.
 
-```json
-{json.dumps(datasets_info, indent=2)}
-```
+The user message contains one or more tasks, each under a `### TASK i` heading with one dataset and the widget fields that visualize it, followed by the target catalog/schema. Analyze every task and return the entries for all of them in a single `datasets_analysis` array.
 
 ## Task - MEASURE-FIRST Approach
 
@@ -144,31 +228,31 @@ Note: {len(datasets_info)} data datasets found ({skipped_count} filter/toggle da
 Return a JSON object with this exact structure:
 
 ```json
-{{
+{
   "datasets_analysis": [
-    {{
+    {
       "dataset_name": "display name (use primary table name if consolidated)",
       "source_type": "single_table" or "joined",
       "primary_table": "catalog.schema.fact_table",
       "tables": ["catalog.schema.table1", "catalog.schema.table2"],
       "joins": [
-        {{
+        {
           "name": "dimension_alias",
           "source": "catalog.schema.dimension_table",
           "on": "source.fk_column = dimension_alias.pk_column"
-        }}
+        }
       ],
       "source_query": "full SQL query ONLY for complex joins that cannot be expressed as simple joins (CTEs, subqueries, UNIONs, window functions). null otherwise.",
       "dimensions": [
-        {{"name": "field_name", "expr": "expression", "description": "optional"}}
+        {"name": "field_name", "expr": "expression", "description": "optional"}
       ],
       "measures": [
-        {{"name": "field_name", "expr": "SUM(column)", "description": "optional"}},
-        {{"name": "window_measure_name", "expr": "SUM(column)", "description": "optional", "window": [{{"order": "date_dimension", "range": "trailing 7 day", "semiadditive": "last"}}]}}
+        {"name": "field_name", "expr": "SUM(column)", "description": "optional"},
+        {"name": "window_measure_name", "expr": "SUM(column)", "description": "optional", "window": [{"order": "date_dimension", "range": "trailing 7 day", "semiadditive": "last"}]}
       ]
-    }}
+    }
   ]
-}}
+}
 ```
 
 ### Window Measures (for SQL window functions)
@@ -187,18 +271,18 @@ When a dataset query uses SQL window functions like `SUM(...) OVER (ORDER BY dat
 
 **Window measure format in the measures array:**
 ```json
-{{
+{
   "name": "clicks_t7d",
   "expr": "SUM(unique_clicks)",
   "description": "7-day trailing sum of unique clicks",
   "window": [
-    {{
+    {
       "order": "date",
       "range": "trailing 7 day",
       "semiadditive": "last"
-    }}
+    }
   ]
-}}
+}
 ```
 
 **Step-by-step process for window functions:**
@@ -227,23 +311,23 @@ clicks_t7d / delivered_t7d AS ctr_t7d
 Required output (ALL THREE measures):
 ```json
 [
-  {{
+  {
     "name": "clicks_t7d",
     "expr": "SUM(unique_clicks)",
     "description": "7-day trailing sum of unique clicks",
-    "window": [{{"order": "date", "range": "trailing 7 day", "semiadditive": "last"}}]
-  }},
-  {{
+    "window": [{"order": "date", "range": "trailing 7 day", "semiadditive": "last"}]
+  },
+  {
     "name": "delivered_t7d",
     "expr": "SUM(total_delivered)",
     "description": "7-day trailing sum of total delivered",
-    "window": [{{"order": "date", "range": "trailing 7 day", "semiadditive": "last"}}]
-  }},
-  {{
+    "window": [{"order": "date", "range": "trailing 7 day", "semiadditive": "last"}]
+  },
+  {
     "name": "ctr_t7d",
     "expr": "MEASURE(clicks_t7d) / NULLIF(MEASURE(delivered_t7d), 0)",
     "description": "7-day trailing click-through rate"
-  }}
+  }
 ]
 ```
 
@@ -296,18 +380,89 @@ Required output (ALL THREE measures):
 - **MEASURE NAMING**: Use the `widget_title` as the measure name when available (normalized to snake_case). If no widget_title exists, fall back to pattern: `aggregation_field` (e.g., `sum_revenue`, `count_orders`, `avg_price`)
 - Normalize all names to snake_case (for the `name` field, but keep `expr` as exact column references)
 
-## Target Catalog/Schema
+Return ONLY the JSON object, no additional text."""
 
-All views will be created in: {target_catalog_schema}
 
-Return ONLY the JSON object, no additional text."""
+def collect_datasets_info(dashboard_json):
+    """Collect the data datasets to analyze, filtering out filter/toggle datasets."""
+    datasets_info = []
+    skipped_count = 0
+    for dataset in dashboard_json.get('datasets', []):
+        query = ''.join(dataset.get('queryLines', []))
+        
+        # Skip filter/toggle datasets that use explode(array(...))
+        if is_filter_dataset(query):
+            skipped_count += 1
+            continue
+        
+        ds_info = {
+            'name': dataset.get('name', ''),
+            'displayName': dataset.get('displayName', ''),
+            'queryLines': query,
+            'columns': dataset.get('columns', [])
+        }
+        datasets_info.append(ds_info)
+    return datasets_info, skipped_count
+
+
+def build_analysis_prompt(datasets_info, widget_fields, target_catalog_schema, skipped_count=0):
+    """Build the (static instructions, per-request payload) prompt pair for a group of datasets."""
+    parts = [f"""## Dashboard Datasets
+
+Note: {len(datasets_info)} data datasets in this request ({skipped_count} filter/toggle datasets were pre-filtered from the dashboard).
+
+Each task lists the widget fields that use its dataset (what's actually visualized). Each field includes:
+- `widget_title`: The title of the widget (use this as the measure name when available)
+- `expression`: The field expression (look for aggregate functions to identify measures)
+"""]
+    for task_id, ds_info in enumerate(datasets_info, start=1):
+        ds_fields = [f for f in widget_fields if f['dataset'] == ds_info['name']]
+        parts.append(f"""### TASK {task_id}
+
+Dataset:
+```json
+{_json_dumps_compact(ds_info)}
+```
+
+Widget fields:
+```json
+{_json_dumps_compact(ds_fields)}
+```
+""")
+    parts.append(f"""## Target Catalog/Schema
+
+All views will be created in: {target_catalog_schema}""")
+    
+    return ANALYSIS_INSTRUCTIONS, '\n'.join(parts)
+
 
-    return prompt
+def analyze_dashboard(dashboard_json, target_catalog_schema, pat_token):
+    """Send the dashboard datasets to the LLM in groups (concurrently); returns one raw response per group."""
+    datasets_info, skipped_count = collect_datasets_info(dashboard_json)
+    if not datasets_info:
+        return []
+    widget_fields = extract_widget_fields(dashboard_json)
+    
+    prompts = [
+        build_analysis_prompt(
+            datasets_info[i:i + ANALYSIS_BATCH_SIZE],
+            widget_fields,
+            target_catalog_schema,
+            skipped_count
+        )
+        for i in range(0, len(datasets_info), ANALYSIS_BATCH_SIZE)
+    ]
+    with ThreadPoolExecutor(max_workers=min(ANALYSIS_MAX_WORKERS, len(prompts))) as executor:
+        return list(executor.map(
+            lambda p: call_foundation_model(p[1], pat_token, system_prompt=p[0]),
+            prompts
+        ))
 
 
 def _render_joins_yaml(joins, indent=0):
     """Recursively render joins into YAML lines."""
     lines = []
+    add = lines.append
     prefix = ' ' * indent
     for join in joins:
         join_name = join.get('name', '')
@@ -316,17 +471,17 @@ def _render_joins_yaml(joins, indent=0):
         join_using = join.get('using', [])
         nested_joins = join.get('joins', [])
         
-        lines.append(f"{prefix}  - name: {join_name}")
-        lines.append(f"{prefix}    source: {join_source}")
+        add(f"{prefix}  - name: {join_name}")
+        add(f"{prefix}    source: {join_source}")
         if join_on:
-            lines.append(f"{prefix}    'on': {join_on}")
+            add(f"{prefix}    'on': {join_on}")
         elif join_using:
-            lines.append(f"{prefix}    using:")
+            add(f"{prefix}    using:")
             for col in join_using:
-                lines.append(f"{prefix}      - {col}")
+                add(f"{prefix}      - {col}")
         
         if nested_joins:
-            lines.append(f"{prefix}    joins:")
+            add(f"{prefix}    joins:")
             lines.extend(_render_joins_yaml(nested_joins, indent + 4))
     
     return lines
@@ -339,160 +494,178 @@ def generate_metrics_view_yaml(dimensions, measures, source, comment, joins=None
         f"source: {source}",
         f'comment: "{comment}"',
     ]
+    add = lines.append
     if joins:
-        lines.append("joins:")
+        add("joins:")
         lines.extend(_render_joins_yaml(joins))
     if dimensions:
-        lines.append("dimensions:")
+        add("dimensions:")
         for dim in dimensions:
             name = dim.get('name', '').lower().replace(' ', '_')
-            expr = dim.get('expr', dim.get('expression', ''))
+            expr = dim['expr'] if 'expr' in dim else dim.get('expression', '')
             desc = dim.get('description', '')
-            lines.append(f"  - name: {name}")
-            lines.append(f"    expr: {expr}")
+            add(f"  - name: {name}")
+            add(f"    expr: {expr}")
             if desc:
-                lines.append(f'    comment: "{desc}"')
+                add(f'    comment: "{desc}"')
     if measures:
-        lines.append("measures:")
+        add("measures:")
         for measure in measures:
             name = measure.get('name', '').lower().replace(' ', '_')
-            expr = measure.get('expr', measure.get('expression', ''))
+            expr = measure['expr'] if 'expr' in measure else measure.get('expression', '')
             desc = measure.get('description', '')
             window = measure.get('window')
-            lines.append(f"  - name: {name}")
-            lines.append(f"    expr: {expr}")
+            add(f"  - name: {name}")
+            add(f"    expr: {expr}")
             if desc:
-                lines.append(f'    comment: "{desc}"')
+                add(f'    comment: "{desc}"')
             if window:
-                lines.append("    window:")
+                add("    window:")
                 for w in window:
                     order = w.get('order', '')
                     w_range = w.get('range', '')
                     semiadditive = w.get('semiadditive', '')
-                    lines.append(f"      - order: {order}")
-                    lines.append(f"        range: {w_range}")
+                    add(f"      - order: {order}")
+                    add(f"        range: {w_range}")
                     if semiadditive:
-                        lines.append(f"        semiadditive: {semiadditive}")
+                        add(f"        semiadditive: {semiadditive}")
     return '\n'.join(lines)
 
 
 def normalize_yaml_indentation(yaml_content):
     """Normalize YAML indentation to ensure root-level properties start at column 0."""
     lines = yaml_content.split('\n')
-    if not lines:
-        return yaml_content
     
-    # Find minimum indentation of non-empty lines
-    min_indent = float('inf')
+    # Find minimum indentation of non-empty lines, stopping at the first
+    # unindented one (the common case for generated YAML)
+    min_indent = None
     for line in lines:
-        if line.strip():  # Skip empty lines
-            indent = len(line) - len(line.lstrip())
-            min_indent = min(min_indent, indent)
+        stripped = line.lstrip()
+        if not stripped:  # Skip empty lines
+            continue
+        indent = len(line) - len(stripped)
+        if indent == 0:
+            return yaml_content.strip()
+        if min_indent is None or indent < min_indent:
+            min_indent = indent
     
-    if min_indent == float('inf') or min_indent == 0:
+    if min_indent is None:
         return yaml_content.strip()
     
-    # Remove the minimum indentation from all lines
-    normalized_lines = []
-    for line in lines:
-        if line.strip():
-            normalized_lines.append(line[min_indent:] if len(line) >= min_indent else line)
-        else:
-            normalized_lines.append('')
-    
-    return '\n'.join(normalized_lines).strip()
+    # Remove the minimum indentation from all lines (blank lines become empty)
+    return '\n'.join(
+        '' if line.isspace() else line[min_indent:] for line in lines
+    ).strip()
 
 
 def generate_create_metrics_view_sql(view_name, yaml_content):
     """Generate the CREATE METRIC VIEW SQL statement."""
+    # Built from two '$' characters so the function body's own delimiter is not closed early
     delimiter = "$" + "$"
-    # Normalize YAML indentation to ensure consistent formatting
-    clean_yaml = normalize_yaml_indentation(yaml_content)
-    return f"""CREATE OR REPLACE VIEW {view_name}
-WITH METRICS
-LANGUAGE YAML
-AS {delimiter}
-{clean_yaml}
-{delimiter}"""
+    return ''.join((
+        'CREATE OR REPLACE VIEW ', view_name,
+        '\nWITH METRICS\nLANGUAGE YAML\nAS ', delimiter, '\n',
+        normalize_yaml_indentation(yaml_content),
+        '\n', delimiter
+    ))
 
 
 def normalize_name(name):
     """Normalize a name to be SQL-safe."""
-    import re
-    normalized = re.sub(r'[^a-zA-Z0-9_]', '_', name)
-    normalized = re.sub(r'_+', '_', normalized)
+    normalized = name.translate(_NAME_TABLE)
+    normalized = _MULTI_UNDERSCORE_RE.sub('_', normalized)
     normalized = normalized.strip('_').lower()
     return normalized
 
 
+def _expr_key(expr):
+    """Dedup key for a dimension/measure expr."""
+    expr = expr.strip()
+    return expr.lower() if expr else expr
+
+
+@dataclasses.dataclass(slots=True)
+class _DatasetGroup:
+    """Accumulator for the datasets merged into one entry by consolidate_datasets."""
+    dataset_name: str
+    primary_table: str
+    source_type: str
+    tables: set = dataclasses.field(default_factory=set)
+    joins: list = dataclasses.field(default_factory=list)
+    source_query: Optional[str] = None
+    dimensions: list = dataclasses.field(default_factory=list)
+    measures: list = dataclasses.field(default_factory=list)
+    seen_dim_exprs: set = dataclasses.field(default_factory=set)
+    seen_measure_exprs: set = dataclasses.field(default_factory=set)
+    seen_join_sources: set = dataclasses.field(default_factory=set)
+
+
 def consolidate_datasets(datasets_analysis):
     """Consolidate datasets sharing the same primary source table into a single entry."""
+    intern = sys.intern
     groups = {}
     for ds in datasets_analysis:
-        primary = ds.get('primary_table', '')
+        ds_get = ds.get
+        primary = ds_get('primary_table', '')
         if not primary:
-            tables = ds.get('tables', [])
+            tables = ds_get('tables', [])
             primary = tables[0] if tables else ''
         
         if not primary:
-            primary = ds.get('dataset_name', f'unknown_{len(groups)}')
-        
-        primary_lower = primary.lower()
-        if primary_lower not in groups:
-            groups[primary_lower] = {
-                'dataset_name': ds.get('dataset_name', ''),
-                'primary_table': primary,
-                'tables': set(),
-                'joins': [],
-                'source_query': None,
-                'dimensions': [],
-                'measures': [],
-                'source_type': ds.get('source_type', 'single_table'),
-                '_seen_dim_exprs': set(),
-                '_seen_measure_exprs': set(),
-                '_seen_join_sources': set(),
-            }
+            primary = ds_get('dataset_name', f'unknown_{len(groups)}')
         
-        group = groups[primary_lower]
+        primary_lower = intern(primary.lower())
+        group = groups.get(primary_lower)
+        if group is None:
+            group = groups[primary_lower] = _DatasetGroup(
+                dataset_name=ds_get('dataset_name', ''),
+                primary_table=intern(primary),
+                source_type=ds_get('source_type', 'single_table')
+            )
         
-        for t in ds.get('tables', []):
-            group['tables'].add(t)
+        group.tables.update(ds_get('tables', ()))
         
-        if ds.get('source_type') == 'joined':
-            group['source_type'] = 'joined'
+        if ds_get('source_type') == 'joined':
+            group.source_type = 'joined'
         
-        for join in ds.get('joins', []) or []:
+        seen_joins = group.seen_join_sources
+        add_join = group.joins.append
+        for join in ds_get('joins') or ():
             join_source = join.get('source', '').lower()
-            if join_source and join_source not in group['_seen_join_sources']:
-                group['_seen_join_sources'].add(join_source)
-                group['joins'].append(join)
+            if join_source and join_source not in seen_joins:
+                seen_joins.add(join_source)
+                add_join(join)
         
-        if ds.get('source_query') and not group['source_query']:
-            group['source_query'] = ds['source_query']
+        if ds_get('source_query') and not group.source_query:
+            group.source_query = ds['source_query']
         
-        for dim in ds.get('dimensions', []):
-            expr_key = dim.get('expr', '').lower().strip()
-            if expr_key and expr_key not in group['_seen_dim_exprs']:
-                group['_seen_dim_exprs'].add(expr_key)
-                group['dimensions'].append(dim)
+        seen_dims = group.seen_dim_exprs
+        add_dim = group.dimensions.append
+        for dim in ds_get('dimensions', ()):
+            expr_key = _expr_key(dim.get('expr', ''))
+            if expr_key and expr_key not in seen_dims:
+                seen_dims.add(expr_key)
+                add_dim(dim)
         
-        for measure in ds.get('measures', []):
-            expr_key = measure.get('expr', '').lower().strip()
-            if expr_key and expr_key not in group['_seen_measure_exprs']:
-                group['_seen_measure_exprs'].add(expr_key)
-                group['measures'].append(measure)
+        seen_measures = group.seen_measure_exprs
+        add_measure = group.measures.append
+        for measure in ds_get('measures', ()):
+            expr_key = _expr_key(measure.get('expr', ''))
+            if expr_key and expr_key not in seen_measures:
+                seen_measures.add(expr_key)
+                add_measure(measure)
     
     consolidated = []
     for group in groups.values():
         entry = {
-            'dataset_name': group['dataset_name'],
-            'source_type': group['source_type'],
-            'primary_table': group['primary_table'],
-            'tables': sorted(group['tables']),
-            'joins': group['joins'] if group['joins'] else None,
-            'source_query': group['source_query'],
-            'dimensions': group['dimensions'],
-            'measures': group['measures'],
+            'dataset_name': group.dataset_name,
+            'source_type': group.source_type,
+            'primary_table': group.primary_table,
+            'tables': sorted(group.tables),
+            'joins': group.joins if group.joins else None,
+            'source_query': group.source_query,
+            'dimensions': group.dimensions,
+            'measures': group.measures,
         }
         consolidated.append(entry)
     
@@ -528,26 +701,33 @@ def validate_join_structure(joins):
         return joins, []
     
     fixes = []
-    top_level_names = {j.get('name', '') for j in joins}
+    top_level_names = {j.get('name', '') for j in joins} - {''}
+    if not top_level_names:
+        return joins, fixes
+    
+    # One alternation over all top-level names, compiled once per call
+    sibling_ref = re.compile(
+        r'(?<!\w)(' + '|'.join(map(re.escape, top_level_names)) + r')\.'
+    )
     
     # Find joins whose 'on' references a sibling (not 'source')
     to_nest = []
     for i, j in enumerate(joins):
         on_clause = j.get('on', '')
-        if not on_clause:
+        if not on_clause or '.' not in on_clause:
             continue
-        for sibling in top_level_names:
-            if sibling == j.get('name', ''):
+        join_name = j.get('name', '')
+        for match in sibling_ref.finditer(on_clause):
+            sibling = match.group(1)
+            if sibling == join_name:
                 continue
-            # Check if 'on' references this sibling join
-            if re.search(rf'(?<!\w){re.escape(sibling)}\.', on_clause):
-                to_nest.append((i, sibling))
-                fixes.append({
-                    'type': 'restructured_nested_join',
-                    'join': j.get('name', ''),
-                    'nested_under': sibling
-                })
-                break
+            to_nest.append((i, sibling))
+            fixes.append({
+                'type': 'restructured_nested_join',
+                'join': join_name,
+                'nested_under': sibling
+            })
+            break
     
     if not to_nest:
         return joins, fixes
@@ -582,18 +762,27 @@ def fix_nested_join_references(dimensions, measures, chain_map):
     
     fixes = []
     
+    # Match 'nested_name.col' but NOT if already preceded by parent chain
+    # Negative lookbehind: don't match if preceded by word char or dot
+    # One alternation over all nested names (longest first), compiled once per call
+    nested_ref = re.compile(
+        r'(?<![\w.])('
+        + '|'.join(map(re.escape, sorted(nested_joins, key=len, reverse=True)))
+        + r')\.'
+    )
+    
+    def to_full_chain(match):
+        return f'{nested_joins[match.group(1)]}.'
+    
     for field_list in [dimensions, measures]:
         for field in field_list:
             expr = field.get('expr', '')
+            # Every nested reference is 'name.col'; without a dot there is nothing to scan
+            if '.' not in expr:
+                continue
             original_expr = expr
             
-            for nested_name, full_chain in nested_joins.items():
-                # Match 'nested_name.col' but NOT if already preceded by parent chain
-                # Negative lookbehind: don't match if preceded by word char or dot
-                pattern = rf'(?<![\w.]){re.escape(nested_name)}\.'
-                replacement = f'{full_chain}.'
-                if re.search(pattern, expr):
-                    expr = re.sub(pattern, replacement, expr)
+            expr = nested_ref.sub(to_full_chain, expr)
             
             if expr != original_expr:
                 fixes.append({
@@ -607,33 +796,52 @@ def fix_nested_join_references(dimensions, measures, chain_map):
     return dimensions, measures, fixes
 
 
+def validate_and_fix_joins(joins, dimensions, measures):
+    """Restructure flat joins that should be nested, then fix field references to nested joins."""
+    if not joins:
+        return joins, dimensions, measures, []
+    joins, fixes = validate_join_structure(joins)
+    # Only nested joins need chained references; skip the chain map for a flat tree
+    if any(j.get('joins') for j in joins):
+        dimensions, measures, ref_fixes = fix_nested_join_references(
+            dimensions, measures, build_join_chain_map(joins)
+        )
+        fixes.extend(ref_fixes)
+    return joins, dimensions, measures, fixes
+
+
 def validate_measure_references(measures):
     """Find MEASURE(x) references that have no corresponding base measure defined."""
-    measure_names = {m['name'] for m in measures}
+    measure_names = frozenset(m['name'] for m in measures)
     missing = {}
+    find_refs = _MEASURE_REF_RE.findall
     for m in measures:
-        for ref in re.findall(r'MEASURE\((\w+)\)', m.get('expr', '')):
+        expr = m.get('expr')
+        # Most measures are plain aggregates; skip the regex unless a ref is possible
+        if not expr or 'MEASURE(' not in expr:
+            continue
+        for ref in find_refs(expr):
             if ref not in measure_names:
                 missing[ref] = m['name']
     return missing
 
 
+def _canonicalize_sql(sql):
+    """Normalize BOM, line endings and trailing whitespace so the same SQL always yields the same bytes."""
+    sql = sql.lstrip('\ufeff').replace('\r\n', '\n').replace('\r', '\n')
+    return '\n'.join(line.rstrip() for line in sql.split('\n')).strip()
+
+
 def build_repair_prompt(missing_refs, all_sql):
     """Build a focused LLM prompt to generate only the missing base window measures."""
     missing_list = '\n'.join(
         f'- {name} (referenced by derived measure: {derived})'
-        for name, derived in missing_refs.items()
+        for name, derived in sorted(missing_refs.items())
     )
+    # Stable content first (instructions, then the dashboard SQL) and the
+    # per-request list last, so repeated calls share a cacheable prompt prefix
     return f"""These base window measures are referenced by MEASURE() but were not defined.
-Generate ONLY the missing base window measures.
-
-Missing measures needed:
-{missing_list}
-
-Original SQL queries (find the OVER clauses that define these aliases):
-```sql
-{all_sql}
-```
+Generate ONLY the missing base window measures listed at the end.
 
 For each missing measure, return:
 - "name": the alias name
@@ -646,6 +854,14 @@ Mapping for RANGE BETWEEN:
 - 27 PRECEDING AND CURRENT ROW = trailing 28 day
 - 90 PRECEDING AND CURRENT ROW = trailing 91 day
 
+Original SQL queries (find the OVER clauses that define these aliases):
+```sql
+{all_sql}
+```
+
+Missing measures needed:
+{missing_list}
+
 Return ONLY a JSON array of the missing measures, nothing else."""
 
 
@@ -653,29 +869,76 @@ def build_semiadditive_prompt(measures_missing_semiadditive, all_sql):
     """Build a focused prompt to determine semiadditive values for window measures."""
     measures_list = '\n'.join(
         f'- {m["name"]} (expr: {m["expr"]}, range: {m["window"][0].get("range", "")})'
-        for m in measures_missing_semiadditive
+        for m in sorted(measures_missing_semiadditive, key=lambda m: m['name'])
     )
-    return f"""For each window measure below, determine the correct semiadditive value.
+    # Stable content first, per-request measure list last (see build_repair_prompt)
+    return f"""For each window measure listed at the end, determine the correct semiadditive value.
 
 semiadditive controls how the measure is summarized when the order dimension
 is NOT in the GROUP BY:
 - "last": use the last value in the window (typical for running totals, trailing sums, end-of-period snapshots)
 - "first": use the first value in the window (typical for opening balances, start-of-period values)
 
-Measures needing semiadditive:
-{measures_list}
+Return a JSON object mapping measure name to semiadditive value ("first" or "last").
+Example: {{"clicks_t28d": "last", "opening_balance": "first"}}
 
 Original SQL for context:
 ```sql
 {all_sql}
 ```
 
-Return a JSON object mapping measure name to semiadditive value ("first" or "last").
-Example: {{"clicks_t28d": "last", "opening_balance": "first"}}
+Measures needing semiadditive:
+{measures_list}
 
 Return ONLY the JSON object, nothing else."""
 
 
+def _measures_missing_semiadditive(consolidated):
+    """(measure, windows lacking 'semiadditive') pairs for window measures across all datasets."""
+    missing = []
+    for ds in consolidated:
+        for m in ds.get('measures', []):
+            missing_windows = [w for w in m.get('window') or () if 'semiadditive' not in w]
+            if missing_windows:
+                missing.append((m, missing_windows))
+    return missing
+
+
+def _request_semiadditive(measures_missing_semi, all_sql, pat_token):
+    """Ask the LLM for each window measure's semiadditive value; None means default to 'last'."""
+    if not all_sql:
+        return None
+    unique_semi = {}
+    for m, _ in measures_missing_semi:
+        unique_semi.setdefault(m['name'], m)
+    try:
+        semi_prompt = build_semiadditive_prompt(list(unique_semi.values()), all_sql)
+        semi_map = _extract_json(call_foundation_model(semi_prompt, pat_token), '{')
+    except Exception:
+        return None
+    return semi_map if isinstance(semi_map, dict) else None
+
+
+def _apply_semiadditive(measures_missing_semi, semi_map, fixes):
+    """Set 'semiadditive' on every window that lacks it, recording each fix."""
+    for m, missing_windows in measures_missing_semi:
+        if semi_map is None:
+            # Fallback: default to 'last' since semiadditive is required
+            value, fix_type = 'last', 'added_semiadditive_fallback'
+        else:
+            value = semi_map.get(m['name'], 'last')
+            if value not in ('first', 'last'):
+                value = 'last'
+            fix_type = 'added_semiadditive'
+        for w in missing_windows:
+            w['semiadditive'] = value
+            fixes.append({
+                'type': fix_type,
+                'measure': m.get('name', ''),
+                'value': value
+            })
+
+
 def validate_and_fix_analysis(consolidated, dashboard_json, pat_token):
     """Post-processing validation layer. Runs after LLM analysis and consolidation.
     
@@ -683,115 +946,111 @@ def validate_and_fix_analysis(consolidated, dashboard_json, pat_token):
       1. Restructure flat joins that should be nested
       2. Fix nested join field references (chained dot notation)
     
-    LLM repair calls (only when needed):
+    LLM repair calls (only when needed; each is one call covering all datasets):
       3. Generate missing base window measures for orphaned MEASURE() references
       4. Determine semiadditive values for window measures missing this required property
     """
+    # Only MEASURE() references and window measures can need an LLM fix (and so
+    # the SQL context); a dashboard with neither those nor joins needs no fixes
+    needs_llm_fixes = any(
+        m.get('window') or 'MEASURE(' in (m.get('expr') or '')
+        for ds in consolidated for m in ds.get('measures', [])
+    )
+    if not needs_llm_fixes and not any(ds.get('joins') for ds in consolidated):
+        return consolidated, []
+    
     # Collect all non-filter dataset SQL queries for potential repair prompts
-    all_queries = []
-    for dataset in dashboard_json.get('datasets', []):
-        query = ''.join(dataset.get('queryLines', []))
-        if query and not is_filter_dataset(query):
-            all_queries.append(query)
-    all_sql = '\n\n'.join(all_queries)
+    all_sql = ''
+    if needs_llm_fixes:
+        all_sql = '\n\n'.join(
+            query
+            for dataset in dashboard_json.get('datasets', ())
+            if (query := _canonicalize_sql(''.join(dataset.get('queryLines', ()))))
+            and not is_filter_dataset(query)
+        )
     
     all_fixes = []
+    # (dataset, orphaned MEASURE() refs) pairs, repaired together in Fix 3
+    missing_by_ds = []
     
     for ds in consolidated:
         joins = ds.get('joins', []) or []
         dimensions = ds.get('dimensions', [])
         measures = ds.get('measures', [])
         
-        # Fix 1: Restructure flat joins that should be nested
-        if joins:
-            joins, join_fixes = validate_join_structure(joins)
-            if join_fixes:
-                ds['joins'] = joins
-                all_fixes.extend(join_fixes)
-        
+        # Fix 1: Restructure flat joins that should be nested, and
         # Fix 2: Fix nested join field references (chained dot notation)
         if joins:
-            chain_map = build_join_chain_map(joins)
-            dimensions, measures, ref_fixes = fix_nested_join_references(
-                dimensions, measures, chain_map
+            joins, dimensions, measures, join_fixes = validate_and_fix_joins(
+                joins, dimensions, measures
             )
+            ds['joins'] = joins
             ds['dimensions'] = dimensions
             ds['measures'] = measures
-            if ref_fixes:
-                all_fixes.extend(ref_fixes)
+            all_fixes.extend(join_fixes)
         
-        # Fix 3: Missing base window measures (LLM repair if needed)
         missing = validate_measure_references(measures)
-        if missing and all_sql:
-            repair_prompt = build_repair_prompt(missing, all_sql)
+        if missing:
+            missing_by_ds.append((ds, missing))
+    
+    all_missing = {}
+    for _, missing in missing_by_ds:
+        for name, derived in missing.items():
+            all_missing.setdefault(name, derived)
+    measures_missing_semi = _measures_missing_semiadditive(consolidated)
+    
+    # The Fix 3 and Fix 4 LLM calls are independent for the measures that exist
+    # now, so they are sent concurrently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        repair_future = None
+        if all_missing and all_sql:
+            repair_future = executor.submit(
+                call_foundation_model, build_repair_prompt(all_missing, all_sql), pat_token
+            )
+        semi_future = None
+        if measures_missing_semi:
+            semi_future = executor.submit(
+                _request_semiadditive, measures_missing_semi, all_sql, pat_token
+            )
+        
+        # Fix 3: Missing base window measures (one LLM repair call for all datasets).
+        # A base measure is defined by its SQL alias, so one definition serves every
+        # dataset that references it.
+        if repair_future is not None:
             try:
-                repair_response = call_foundation_model(repair_prompt, pat_token)
-                json_match = re.search(r'\[[\s\S]*\]', repair_response)
-                if json_match:
-                    repaired = json.loads(json_match.group())
-                    # Insert base measures BEFORE existing measures
-                    ds['measures'] = repaired + measures
+                repaired = [(m['name'], m) for m in _extract_json(repair_future.result(), '[')]
+            except Exception:
+                repaired = None
+            
+            for ds, missing in missing_by_ds:
+                if repaired is None:
                     all_fixes.append({
-                        'type': 'repaired_missing_measures',
+                        'type': 'repair_failed',
                         'dataset': ds.get('dataset_name', ''),
-                        'added': [m['name'] for m in repaired]
+                        'missing': list(missing.keys())
                     })
-            except Exception:
+                    continue
+                added = [copy.deepcopy(m) for name, m in repaired if name in missing]
+                # Insert base measures BEFORE existing measures (in place, no list copy)
+                ds.setdefault('measures', [])[:0] = added
                 all_fixes.append({
-                    'type': 'repair_failed',
+                    'type': 'repaired_missing_measures',
                     'dataset': ds.get('dataset_name', ''),
-                    'missing': list(missing.keys())
+                    'added': [m['name'] for m in added]
                 })
         
         # Fix 4: Ensure all window measures have required 'semiadditive' property
-        # Re-read measures in case Fix 3 modified ds['measures']
-        measures = ds.get('measures', [])
-        measures_missing_semi = [
-            m for m in measures
-            if m.get('window') and any('semiadditive' not in w for w in m['window'])
-        ]
-        if measures_missing_semi:
-            if all_sql:
-                semi_prompt = build_semiadditive_prompt(measures_missing_semi, all_sql)
-                try:
-                    semi_response = call_foundation_model(semi_prompt, pat_token)
-                    semi_match = re.search(r'\{[\s\S]*\}', semi_response)
-                    if semi_match:
-                        semi_map = json.loads(semi_match.group())
-                        for m in measures_missing_semi:
-                            value = semi_map.get(m['name'], 'last')
-                            if value not in ('first', 'last'):
-                                value = 'last'
-                            for w in m.get('window', []):
-                                if 'semiadditive' not in w:
-                                    w['semiadditive'] = value
-                                    all_fixes.append({
-                                        'type': 'added_semiadditive',
-                                        'measure': m.get('name', ''),
-                                        'value': value
-                                    })
-                except Exception:
-                    # Fallback: default to 'last' since semiadditive is required
-                    for m in measures_missing_semi:
-                        for w in m.get('window', []):
-                            if 'semiadditive' not in w:
-                                w['semiadditive'] = 'last'
-                                all_fixes.append({
-                                    'type': 'added_semiadditive_fallback',
-                                    'measure': m.get('name', ''),
-                                    'value': 'last'
-                                })
-            else:
-                # No SQL context available, default to 'last'
-                for m in measures_missing_semi:
-                    for w in m.get('window', []):
-                        if 'semiadditive' not in w:
-                            w['semiadditive'] = 'last'
-                            all_fixes.append({
-                                'type': 'added_semiadditive_fallback',
-                                'measure': m.get('name', ''),
-                                'value': 'last'
-                            })
+        if semi_future is not None:
+            _apply_semiadditive(measures_missing_semi, semi_future.result(), all_fixes)
+    
+    # Measures added by Fix 3 may still lack semiadditive; ask once more for those
+    late_missing_semi = _measures_missing_semiadditive(consolidated)
+    if late_missing_semi:
+        _apply_semiadditive(
+            late_missing_semi,
+            _request_semiadditive(late_missing_semi, all_sql, pat_token),
+            all_fixes
+        )
     
     return consolidated, all_fixes
 
@@ -814,30 +1073,27 @@ try:
             "status": "error"
         })
     
-    dashboard_json = json.loads(dashboard.serialized_dashboard)
+    dashboard_json = _json_loads(dashboard.serialized_dashboard)
     
-    # Call LLM to analyze dashboard structure
-    analysis_prompt = build_analysis_prompt(dashboard_json, target_catalog_schema)
-    llm_response = call_foundation_model(analysis_prompt, pat_token)
+    # Call LLM to analyze dataset groups
+    llm_responses = analyze_dashboard(dashboard_json, target_catalog_schema, pat_token)
     
-    # Parse LLM response
-    try:
-        # Try to extract JSON from response (in case there's extra text)
-        json_match = re.search(r'\{[\s\S]*\}', llm_response)
-        if json_match:
-            analysis_result = json.loads(json_match.group())
-        else:
-            analysis_result = json.loads(llm_response)
-    except json.JSONDecodeError as e:
-        return json.dumps({
-            "dashboard_id": dashboard_id,
-            "error": f"Failed to parse LLM response as JSON: {str(e)}",
-            "llm_response": llm_response[:1000],
-            "status": "error"
-        })
+    # Parse LLM responses
+    datasets_analysis = []
+    for llm_response in llm_responses:
+        try:
+            # Extract the JSON object from the response (in case there's extra text)
+            analysis_result = _extract_json(llm_response, '{')
+        except json.JSONDecodeError as e:
+            return json.dumps({
+                "dashboard_id": dashboard_id,
+                "error": f"Failed to parse LLM response as JSON: {str(e)}",
+                "llm_response": llm_response[:1000],
+                "status": "error"
+            })
+        datasets_analysis.extend(analysis_result.get('datasets_analysis', []))
     
-    # Consolidate datasets sharing the same primary source table
-    datasets_analysis = analysis_result.get('datasets_analysis', [])
+    # Consolidate datasets sharing the same primary source table (across dataset groups)
     consolidated = consolidate_datasets(datasets_analysis)
     
     # Validation layer: fix nested joins, field references, and missing measures
@@ -8,29 +8,228 @@ This script mirrors the UC function (extract_dashboard_metrics_uc_function.sql)
 and uses Claude Opus 4.5 for intelligent classification of dimensions and measures.
 """
 
+import copy
+import dataclasses
+import hashlib
 import json
+import os
 import re
+import sys
+import tempfile
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from urllib3.util import Retry
 from typing import Optional
 from databricks.sdk import WorkspaceClient
 
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib json module
+    orjson = None
+
 
 # Configuration
 DATABRICKS_HOST = "https://<your-workspace>.cloud.databricks.com"
 LLM_MODEL = "databricks-claude-opus-4-5"
 
+# Dashboard analysis is split into requests of at most ANALYSIS_BATCH_SIZE
+# datasets each, sent concurrently
+ANALYSIS_BATCH_SIZE = 4
+ANALYSIS_MAX_WORKERS = 8
+
+# Dashboards processed at once by process_dashboards (each one still fans its
+# own analysis batches out over ANALYSIS_MAX_WORKERS)
+DASHBOARD_MAX_WORKERS = 4
+
+# Overall cap on LLM calls in flight across all threads, so concurrent
+# dashboards don't multiply into 429 bursts or outgrow the connection pool
+LLM_MAX_CONCURRENT_CALLS = 8
+_LLM_CALL_SLOTS = threading.BoundedSemaphore(LLM_MAX_CONCURRENT_CALLS)
+
+# Shared HTTP session: keeps connections alive across LLM calls and retries
+# rate-limited (429) and transient 5xx responses with exponential backoff.
+# read=0: a request that reached the endpoint is never re-sent after a read
+# error or timeout, which would re-bill a long generation
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=3,
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False
+    )
+))
+
+# Precompiled regular expressions
+_MULTI_UNDERSCORE_RE = re.compile(r'_+')
+# Filter datasets typically use explode(array(...)) to create dropdown options
+_FILTER_DATASET_RE = re.compile(r'explode\s*\(\s*array\s*\(', re.IGNORECASE)
+# MEASURE(name) references inside derived measure expressions
+_MEASURE_REF_RE = re.compile(r'MEASURE\((\w+)\)')
+
+
+class _NameTranslationTable(dict):
+    """str.translate table mapping every character outside [a-zA-Z0-9_] to '_'.
+    
+    ASCII is precomputed; any other code point falls through to __missing__.
+    """
+    def __missing__(self, codepoint):
+        return '_'
+
+
+_NAME_TABLE = _NameTranslationTable(
+    (i, chr(i) if chr(i).isalnum() or chr(i) == '_' else '_') for i in range(128)
+)
+
+# Local LLM response cache (set DASHBOARD_METRICS_NO_CACHE=1 to bypass)
+LLM_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "dashboard_metrics")
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+
+def _json_loads(data):
+    """Parse JSON from str or bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps_compact(obj) -> str:
+    """Serialize to compact JSON (no whitespace, non-ASCII kept), using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+
+def _json_dumps_bytes(obj) -> bytes:
+    """Serialize to compact UTF-8 JSON bytes for a request body, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+_JSON_DECODER = json.JSONDecoder()
+
 
-def call_foundation_model(prompt: str, pat_token: str) -> str:
+def _extract_json(text: str, opener: str = '{'):
+    """
+    Decode the first JSON value embedded in an LLM response.
+    
+    Scans from each occurrence of opener and decodes exactly one value with
+    JSONDecoder.raw_decode, so prose before or after the JSON is ignored and
+    the scan stays linear for well-formed responses.
+    
+    Args:
+        text: The LLM response text
+        opener: '{' to find a JSON object, '[' to find a JSON array
+    
+    Returns:
+        The decoded JSON value
+    
+    Raises:
+        json.JSONDecodeError: If no JSON value can be decoded from the text
+    """
+    # Fast path: the model usually returns nothing but the JSON value
+    stripped = text.strip()
+    if orjson is not None and stripped.startswith(opener):
+        try:
+            return orjson.loads(stripped)
+        except orjson.JSONDecodeError:
+            pass
+    i = text.find(opener)
+    while i != -1:
+        try:
+            return _JSON_DECODER.raw_decode(text, i)[0]
+        except json.JSONDecodeError:
+            i = text.find(opener, i + 1)
+    # Nothing embedded decoded; let json report the error for the whole text
+    return json.loads(text)
+
+
+def _llm_cache_key(prompt: str, system_prompt: Optional[str] = None) -> str:
+    """Hash the model name and full prompt into a cache key."""
+    key_source = LLM_MODEL + "\0" + (system_prompt or "") + "\0" + prompt
+    return hashlib.sha256(key_source.encode()).hexdigest()
+
+
+def _read_llm_cache(key: str) -> Optional[str]:
+    """Return the cached response for key, or None if missing, expired or unreadable."""
+    path = os.path.join(LLM_CACHE_DIR, f"{key}.json")
+    try:
+        if time.time() - os.path.getmtime(path) > LLM_CACHE_TTL_SECONDS:
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)["response"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _write_llm_cache(key: str, response: str) -> None:
+    """Atomically write a response to the cache. Failures are ignored."""
+    try:
+        os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=LLM_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({
+                "prompt_hash": key,
+                "model": LLM_MODEL,
+                "response": response,
+                "ts": time.time()
+            }, f)
+        os.replace(tmp_path, os.path.join(LLM_CACHE_DIR, f"{key}.json"))
+    except OSError:
+        pass
+
+
+def _discard_llm_cache(prompt: str, system_prompt: Optional[str] = None) -> None:
+    """Remove the cached response for a prompt, e.g. after it failed to parse."""
+    try:
+        os.remove(os.path.join(LLM_CACHE_DIR, f"{_llm_cache_key(prompt, system_prompt)}.json"))
+    except OSError:
+        pass
+
+
+def call_foundation_model(
+    prompt: str,
+    pat_token: str,
+    system_prompt: Optional[str] = None,
+    use_cache: bool = True
+) -> str:
     """
     Call Databricks Foundation Model API with Claude Opus 4.5.
     
+    When a system prompt is given it is sent as a separate block marked with
+    ``cache_control`` so the endpoint can reuse it across calls (prompt caching).
+    
+    Responses are cached on disk under LLM_CACHE_DIR, keyed by a SHA-256 of the
+    model and prompt, so re-running on an unchanged dashboard skips the API call.
+    Entries expire after LLM_CACHE_TTL_SECONDS. Truncated completions and bodies
+    without ``choices`` are never cached; callers that fail to parse a response
+    drop its entry with _discard_llm_cache so a re-run asks the model again.
+    
     Args:
         prompt: The prompt to send to the LLM
         pat_token: Personal Access Token for authentication
+        system_prompt: Optional static instructions to send as a cached system block
+        use_cache: Read/write the local response cache (also disabled by setting
+                   the DASHBOARD_METRICS_NO_CACHE environment variable)
     
     Returns:
         The LLM response content as a string
     """
+    use_cache = use_cache and not os.environ.get("DASHBOARD_METRICS_NO_CACHE")
+    if use_cache:
+        cache_key = _llm_cache_key(prompt, system_prompt)
+        cached = _read_llm_cache(cache_key)
+        if cached is not None:
+            return cached
+    
     url = f"{DATABRICKS_HOST}/serving-endpoints/{LLM_MODEL}/invocations"
     
     headers = {
@@ -40,19 +239,33 @@ def call_foundation_model(prompt: str, pat_token: str) -> str:
     
     payload = {
         "messages": [
-            {"role": "user", "content": prompt}
+            {"role": "user", "content": [{"type": "text", "text": prompt}]}
         ],
         "max_tokens": 32000
     }
+    if system_prompt:
+        payload["system"] = [
+            {"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}
+        ]
     
-    response = requests.post(url, headers=headers, json=payload, timeout=120)
+    # Encode the body once ourselves; json= would re-serialize it with stdlib json
+    body = _json_dumps_bytes(payload)
+    with _LLM_CALL_SLOTS:
+        response = _SESSION.post(url, headers=headers, data=body, timeout=120)
     response.raise_for_status()
     
-    result = response.json()
-    # Extract content from response
-    if "choices" in result and len(result["choices"]) > 0:
-        return result["choices"][0]["message"]["content"]
-    return result.get("content", str(result))
+    result = _json_loads(response.content)
+    # Extract content from response; chat completions are the common case
+    try:
+        choice = result["choices"][0]
+    except (KeyError, IndexError):
+        return result.get("content", str(result))
+    content = choice["message"]["content"]
+    
+    # A completion cut off at max_tokens is never valid JSON; don't pin it
+    if use_cache and choice.get("finish_reason") != "length":
+        _write_llm_cache(cache_key, content)
+    return content
 
 
 def is_filter_dataset(query: str) -> bool:
@@ -65,93 +278,71 @@ def is_filter_dataset(query: str) -> bool:
     Returns:
         True if the dataset is a filter/toggle dataset
     """
-    if not query:
-        return False
-    query_lower = query.lower()
-    # Filter datasets typically use explode(array(...)) to create dropdown options
-    return 'explode(array(' in query_lower or 'explode (array(' in query_lower
+    # Case-insensitive search avoids lowercasing a copy of the whole query
+    return bool(query and _FILTER_DATASET_RE.search(query))
 
 
 def extract_widget_fields(dashboard_json: dict) -> list[dict]:
     """
     Extract fields used in widget visualizations, including widget titles.
     
+    Fields with neither a name nor an expression are skipped, and a field that
+    appears in several widgets (same dataset, name and expression) is kept once,
+    with the title of the first widget.
+    
     Args:
         dashboard_json: The parsed dashboard JSON
     
     Returns:
         List of field dicts with 'dataset', 'widget_title', 'name', 'expression'
     """
-    widget_fields = []
-    for page in dashboard_json.get('pages', []):
-        for layout_item in page.get('layout', []):
-            widget = layout_item.get('widget', {})
-            widget_title = widget.get('name', '')  # Widget title for measure naming
-            for query in widget.get('queries', []):
-                query_obj = query.get('query', {})
-                dataset_name = query_obj.get('datasetName', '')
-                for field in query_obj.get('fields', []):
-                    widget_fields.append({
-                        'dataset': dataset_name,
-                        'widget_title': widget_title,  # Include widget title
-                        'name': field.get('name', ''),
-                        'expression': field.get('expression', '')
-                    })
-    return widget_fields
-
-
-def build_analysis_prompt(dashboard_json: dict, target_catalog_schema: str) -> str:
-    """
-    Build the prompt for LLM to analyze dashboard structure.
-    
-    Args:
-        dashboard_json: The parsed dashboard JSON
-        target_catalog_schema: Target catalog.schema where views will be created
+    # Single flat generator; empty tuples as defaults avoid allocating on misses
+    fields = (
+        (
+            query_obj.get('datasetName', ''),
+            widget.get('name', ''),  # Widget title for measure naming
+            field
+        )
+        for page in dashboard_json.get('pages', ())
+        for layout_item in page.get('layout', ())
+        for widget in (layout_item.get('widget', {}),)
+        for query in widget.get('queries', ())
+        for query_obj in (query.get('query', {}),)
+        for field in query_obj.get('fields', ())
+    )
     
-    Returns:
-        The prompt string for the LLM
-    """
-    # Extract datasets info for the prompt, filtering out filter/toggle datasets
-    datasets_info = []
-    skipped_count = 0
-    for dataset in dashboard_json.get('datasets', []):
-        query = ''.join(dataset.get('queryLines', []))
-        
-        # Skip filter/toggle datasets that use explode(array(...))
-        if is_filter_dataset(query):
-            skipped_count += 1
+    widget_fields = []
+    seen = set()
+    for dataset_name, widget_title, field in fields:
+        # Fields almost always carry both keys; only fall back to .get() when not
+        try:
+            name = field['name']
+            expression = field['expression']
+        except KeyError:
+            name = field.get('name', '')
+            expression = field.get('expression', '')
+        # Skip empty placeholder fields and repeats of the same field
+        if not name and not expression:
             continue
-        
-        ds_info = {
-            'name': dataset.get('name', ''),
-            'displayName': dataset.get('displayName', ''),
-            'queryLines': query,
-            'columns': dataset.get('columns', [])
-        }
-        datasets_info.append(ds_info)
-    
-    # Extract widget fields to identify what's actually being used
-    widget_fields = extract_widget_fields(dashboard_json)
-    
-    prompt = f"""Analyze this Databricks dashboard using a MEASURE-FIRST approach.
-
-## Widget Fields (what's actually visualized)
-
-These are the fields used in dashboard widgets. Each field includes:
-- `widget_title`: The title of the widget (use this as the measure name when available)
-- `expression`: The field expression (look for aggregate functions to identify measures)
-
-```json
-{json.dumps(widget_fields, indent=2)}
-```
+        key = (dataset_name, name, expression)
+        if key in seen:
+            continue
+        seen.add(key)
+        widget_fields.append({
+            'dataset': dataset_name,
+            'widget_title': widget_title,
+            'name': name,
+            'expression': expression
+        })
+    return widget_fields
 
-## Dashboard Datasets
 
-Note: {len(datasets_info)} data datasets found ({skipped_count} filter/toggle datasets were pre-filtered).
+# Static instructions for the dashboard analysis call. Sent as a cached system
+# block, so this text must stay byte-identical between calls: never interpolate
+# per-dashboard values into it (they belong in the user message instead).
+ANALYSIS_INSTRUCTIONS = """Analyze the Databricks dashboard datasets provided in the user message using a MEASURE-FIRST approach.
 
-```json
-{json.dumps(datasets_info, indent=2)}
-```
+The user message contains one or more tasks, each under a `### TASK i` heading with one dataset and the widget fields that visualize it, followed by the target catalog/schema. Analyze every task and return the entries for all of them in a single `datasets_analysis` array.
 
 ## Task - MEASURE-FIRST Approach
 
@@ -177,31 +368,31 @@ Note: {len(datasets_info)} data datasets found ({skipped_count} filter/toggle da
 Return a JSON object with this exact structure:
 
 ```json
-{{
+{
   "datasets_analysis": [
-    {{
+    {
       "dataset_name": "display name (use primary table name if consolidated)",
       "source_type": "single_table" or "joined",
       "primary_table": "catalog.schema.fact_table",
       "tables": ["catalog.schema.table1", "catalog.schema.table2"],
       "joins": [
-        {{
+        {
           "name": "dimension_alias",
           "source": "catalog.schema.dimension_table",
           "on": "source.fk_column = dimension_alias.pk_column"
-        }}
+        }
       ],
       "source_query": "full SQL query ONLY for complex joins that cannot be expressed as simple joins (CTEs, subqueries, UNIONs, window functions). null otherwise.",
       "dimensions": [
-        {{"name": "field_name", "expr": "expression", "description": "optional"}}
+        {"name": "field_name", "expr": "expression", "description": "optional"}
       ],
       "measures": [
-        {{"name": "field_name", "expr": "SUM(column)", "description": "optional"}},
-        {{"name": "window_measure_name", "expr": "SUM(column)", "description": "optional", "window": [{{"order": "date_dimension", "range": "trailing 7 day", "semiadditive": "last"}}]}}
+        {"name": "field_name", "expr": "SUM(column)", "description": "optional"},
+        {"name": "window_measure_name", "expr": "SUM(column)", "description": "optional", "window": [{"order": "date_dimension", "range": "trailing 7 day", "semiadditive": "last"}]}
       ]
-    }}
+    }
   ]
-}}
+}
 ```
 
 ### Window Measures (for SQL window functions)
@@ -220,18 +411,18 @@ When a dataset query uses SQL window functions like `SUM(...) OVER (ORDER BY dat
 
 **Window measure format in the measures array:**
 ```json
-{{
+{
   "name": "clicks_t7d",
   "expr": "SUM(unique_clicks)",
   "description": "7-day trailing sum of unique clicks",
   "window": [
-    {{
+    {
       "order": "date",
       "range": "trailing 7 day",
       "semiadditive": "last"
-    }}
+    }
   ]
-}}
+}
 ```
 
 **Step-by-step process for window functions:**
@@ -260,23 +451,23 @@ clicks_t7d / delivered_t7d AS ctr_t7d
 Required output (ALL THREE measures):
 ```json
 [
-  {{
+  {
     "name": "clicks_t7d",
     "expr": "SUM(unique_clicks)",
     "description": "7-day trailing sum of unique clicks",
-    "window": [{{"order": "date", "range": "trailing 7 day", "semiadditive": "last"}}]
-  }},
-  {{
+    "window": [{"order": "date", "range": "trailing 7 day", "semiadditive": "last"}]
+  },
+  {
     "name": "delivered_t7d",
     "expr": "SUM(total_delivered)",
     "description": "7-day trailing sum of total delivered",
-    "window": [{{"order": "date", "range": "trailing 7 day", "semiadditive": "last"}}]
-  }},
-  {{
+    "window": [{"order": "date", "range": "trailing 7 day", "semiadditive": "last"}]
+  },
+  {
     "name": "ctr_t7d",
     "expr": "MEASURE(clicks_t7d) / NULLIF(MEASURE(delivered_t7d), 0)",
     "description": "7-day trailing click-through rate"
-  }}
+  }
 ]
 ```
 
@@ -329,13 +520,139 @@ Required output (ALL THREE measures):
 - **MEASURE NAMING**: Use the `widget_title` as the measure name when available (normalized to snake_case). If no widget_title exists, fall back to pattern: `aggregation_field` (e.g., `sum_revenue`, `count_orders`, `avg_price`)
 - Normalize all names to snake_case (for the `name` field, but keep `expr` as exact column references)
 
-## Target Catalog/Schema
+Return ONLY the JSON object, no additional text."""
 
-All views will be created in: {target_catalog_schema}
 
-Return ONLY the JSON object, no additional text."""
+def collect_datasets_info(dashboard_json: dict) -> tuple[list[dict], int]:
+    """
+    Collect the data datasets to analyze, filtering out filter/toggle datasets.
+    
+    Args:
+        dashboard_json: The parsed dashboard JSON
+    
+    Returns:
+        Tuple of (list of dataset info dicts, number of filter datasets skipped)
+    """
+    datasets_info = []
+    skipped_count = 0
+    for dataset in dashboard_json.get('datasets', []):
+        query = ''.join(dataset.get('queryLines', []))
+        
+        # Skip filter/toggle datasets that use explode(array(...))
+        if is_filter_dataset(query):
+            skipped_count += 1
+            continue
+        
+        ds_info = {
+            'name': dataset.get('name', ''),
+            'displayName': dataset.get('displayName', ''),
+            'queryLines': query,
+            'columns': dataset.get('columns', [])
+        }
+        datasets_info.append(ds_info)
+    return datasets_info, skipped_count
+
+
+def build_analysis_prompt(
+    datasets_info: list[dict],
+    widget_fields: list[dict],
+    target_catalog_schema: str,
+    skipped_count: int = 0
+) -> tuple[str, str]:
+    """
+    Build the prompt for LLM to analyze a group of dashboard datasets.
+    
+    Each dataset becomes a `### TASK i` section together with the widget fields
+    that use it. The prompt is split in two so the large instruction block can be
+    cached by the model endpoint: only the per-request payload changes between calls.
+    
+    Args:
+        datasets_info: Dataset info dicts to analyze (from collect_datasets_info)
+        widget_fields: Widget fields of the dashboard (from extract_widget_fields)
+        target_catalog_schema: Target catalog.schema where views will be created
+        skipped_count: Number of filter/toggle datasets skipped in the dashboard
+    
+    Returns:
+        Tuple of (static instructions, per-request payload)
+    """
+    parts = [f"""## Dashboard Datasets
+
+Note: {len(datasets_info)} data datasets in this request ({skipped_count} filter/toggle datasets were pre-filtered from the dashboard).
+
+Each task lists the widget fields that use its dataset (what's actually visualized). Each field includes:
+- `widget_title`: The title of the widget (use this as the measure name when available)
+- `expression`: The field expression (look for aggregate functions to identify measures)
+"""]
+    for task_id, ds_info in enumerate(datasets_info, start=1):
+        ds_fields = [f for f in widget_fields if f['dataset'] == ds_info['name']]
+        parts.append(f"""### TASK {task_id}
+
+Dataset:
+```json
+{_json_dumps_compact(ds_info)}
+```
+
+Widget fields:
+```json
+{_json_dumps_compact(ds_fields)}
+```
+""")
+    parts.append(f"""## Target Catalog/Schema
+
+All views will be created in: {target_catalog_schema}""")
+    
+    return ANALYSIS_INSTRUCTIONS, '\n'.join(parts)
 
-    return prompt
+
+def analyze_dashboard(
+    dashboard_json: dict,
+    target_catalog_schema: str,
+    pat_token: str
+) -> list[str]:
+    """
+    Send the dashboard datasets to the LLM in groups, running the groups concurrently.
+    
+    Args:
+        dashboard_json: The parsed dashboard JSON
+        target_catalog_schema: Target catalog.schema where views will be created
+        pat_token: Personal Access Token for LLM API calls
+    
+    Returns:
+        List of raw LLM responses, one per group of datasets
+    """
+    datasets_info, skipped_count = collect_datasets_info(dashboard_json)
+    if not datasets_info:
+        return []
+    widget_fields = extract_widget_fields(dashboard_json)
+    
+    prompts = [
+        build_analysis_prompt(
+            datasets_info[i:i + ANALYSIS_BATCH_SIZE],
+            widget_fields,
+            target_catalog_schema,
+            skipped_count
+        )
+        for i in range(0, len(datasets_info), ANALYSIS_BATCH_SIZE)
+    ]
+    with ThreadPoolExecutor(max_workers=min(ANALYSIS_MAX_WORKERS, len(prompts))) as executor:
+        return list(executor.map(
+            lambda p: _call_analysis_group(p[0], p[1], pat_token),
+            prompts
+        ))
+
+
+def _call_analysis_group(system_prompt: str, prompt: str, pat_token: str) -> str:
+    """Run one analysis request, dropping its cache entry if the reply is not JSON.
+    
+    The raw response is returned either way; extract_dashboard_metrics reports
+    the parse error, and a re-run then asks the model again.
+    """
+    llm_response = call_foundation_model(prompt, pat_token, system_prompt=system_prompt)
+    try:
+        _extract_json(llm_response, '{')
+    except json.JSONDecodeError:
+        _discard_llm_cache(prompt, system_prompt)
+    return llm_response
 
 
 def _render_joins_yaml(joins: list[dict], indent: int = 0) -> list[str]:
@@ -350,6 +667,7 @@ def _render_joins_yaml(joins: list[dict], indent: int = 0) -> list[str]:
         List of YAML lines for the joins block
     """
     lines = []
+    add = lines.append
     prefix = ' ' * indent
     for join in joins:
         join_name = join.get('name', '')
@@ -358,18 +676,18 @@ def _render_joins_yaml(joins: list[dict], indent: int = 0) -> list[str]:
         join_using = join.get('using', [])
         nested_joins = join.get('joins', [])
         
-        lines.append(f"{prefix}  - name: {join_name}")
-        lines.append(f"{prefix}    source: {join_source}")
+        add(f"{prefix}  - name: {join_name}")
+        add(f"{prefix}    source: {join_source}")
         if join_on:
             # Quote the 'on' key to avoid YAML 1.1 boolean interpretation
-            lines.append(f"{prefix}    'on': {join_on}")
+            add(f"{prefix}    'on': {join_on}")
         elif join_using:
-            lines.append(f"{prefix}    using:")
+            add(f"{prefix}    using:")
             for col in join_using:
-                lines.append(f"{prefix}      - {col}")
+                add(f"{prefix}      - {col}")
         
         if nested_joins:
-            lines.append(f"{prefix}    joins:")
+            add(f"{prefix}    joins:")
             lines.extend(_render_joins_yaml(nested_joins, indent + 4))
     
     return lines
@@ -401,40 +719,41 @@ def generate_metrics_view_yaml(
         f"source: {source}",
         f'comment: "{comment}"',
     ]
+    add = lines.append
     if joins:
-        lines.append("joins:")
+        add("joins:")
         lines.extend(_render_joins_yaml(joins))
     if dimensions:
-        lines.append("dimensions:")
+        add("dimensions:")
         for dim in dimensions:
             name = dim.get('name', '').lower().replace(' ', '_')
-            expr = dim.get('expr', dim.get('expression', ''))
+            expr = dim['expr'] if 'expr' in dim else dim.get('expression', '')
             desc = dim.get('description', '')
-            lines.append(f"  - name: {name}")
-            lines.append(f"    expr: {expr}")
+            add(f"  - name: {name}")
+            add(f"    expr: {expr}")
             if desc:
-                lines.append(f'    comment: "{desc}"')
+                add(f'    comment: "{desc}"')
     if measures:
-        lines.append("measures:")
+        add("measures:")
         for measure in measures:
             name = measure.get('name', '').lower().replace(' ', '_')
-            expr = measure.get('expr', measure.get('expression', ''))
+            expr = measure['expr'] if 'expr' in measure else measure.get('expression', '')
             desc = measure.get('description', '')
             window = measure.get('window')
-            lines.append(f"  - name: {name}")
-            lines.append(f"    expr: {expr}")
+            add(f"  - name: {name}")
+            add(f"    expr: {expr}")
             if desc:
-                lines.append(f'    comment: "{desc}"')
+                add(f'    comment: "{desc}"')
             if window:
-                lines.append("    window:")
+                add("    window:")
                 for w in window:
                     order = w.get('order', '')
                     w_range = w.get('range', '')
                     semiadditive = w.get('semiadditive', '')
-                    lines.append(f"      - order: {order}")
-                    lines.append(f"        range: {w_range}")
+                    add(f"      - order: {order}")
+                    add(f"        range: {w_range}")
                     if semiadditive:
-                        lines.append(f"        semiadditive: {semiadditive}")
+                        add(f"        semiadditive: {semiadditive}")
     return '\n'.join(lines)
 
 
@@ -449,28 +768,27 @@ def normalize_yaml_indentation(yaml_content: str) -> str:
         Normalized YAML content
     """
     lines = yaml_content.split('\n')
-    if not lines:
-        return yaml_content
     
-    # Find minimum indentation of non-empty lines
-    min_indent = float('inf')
+    # Find minimum indentation of non-empty lines, stopping at the first
+    # unindented one (the common case for generated YAML)
+    min_indent = None
     for line in lines:
-        if line.strip():  # Skip empty lines
-            indent = len(line) - len(line.lstrip())
-            min_indent = min(min_indent, indent)
+        stripped = line.lstrip()
+        if not stripped:  # Skip empty lines
+            continue
+        indent = len(line) - len(stripped)
+        if indent == 0:
+            return yaml_content.strip()
+        if min_indent is None or indent < min_indent:
+            min_indent = indent
     
-    if min_indent == float('inf') or min_indent == 0:
+    if min_indent is None:
         return yaml_content.strip()
     
-    # Remove the minimum indentation from all lines
-    normalized_lines = []
-    for line in lines:
-        if line.strip():
-            normalized_lines.append(line[min_indent:] if len(line) >= min_indent else line)
-        else:
-            normalized_lines.append('')
-    
-    return '\n'.join(normalized_lines).strip()
+    # Remove the minimum indentation from all lines (blank lines become empty)
+    return '\n'.join(
+        '' if line.isspace() else line[min_indent:] for line in lines
+    ).strip()
 
 
 def generate_create_metrics_view_sql(view_name: str, yaml_content: str) -> str:
@@ -484,15 +802,14 @@ def generate_create_metrics_view_sql(view_name: str, yaml_content: str) -> str:
     Returns:
         SQL DDL statement
     """
-    delimiter = "$" + "$"
-    # Normalize YAML indentation to ensure consistent formatting
-    clean_yaml = normalize_yaml_indentation(yaml_content)
-    return f"""CREATE OR REPLACE VIEW {view_name}
-WITH METRICS
-LANGUAGE YAML
-AS {delimiter}
-{clean_yaml}
-{delimiter}"""
+    # Normalize YAML indentation to ensure consistent formatting (returns right
+    # after the first line for YAML that already starts at column 0)
+    return ''.join((
+        'CREATE OR REPLACE VIEW ', view_name,
+        '\nWITH METRICS\nLANGUAGE YAML\nAS $$\n',
+        normalize_yaml_indentation(yaml_content),
+        '\n$$'
+    ))
 
 
 def normalize_name(name: str) -> str:
@@ -505,12 +822,34 @@ def normalize_name(name: str) -> str:
     Returns:
         Normalized name in snake_case
     """
-    normalized = re.sub(r'[^a-zA-Z0-9_]', '_', name)
-    normalized = re.sub(r'_+', '_', normalized)
+    normalized = name.translate(_NAME_TABLE)
+    normalized = _MULTI_UNDERSCORE_RE.sub('_', normalized)
     normalized = normalized.strip('_').lower()
     return normalized
 
 
+def _expr_key(expr: str) -> str:
+    """Dedup key for a dimension/measure expr: trimmed first, so only the trimmed text is lowercased."""
+    expr = expr.strip()
+    return expr.lower() if expr else expr
+
+
+@dataclasses.dataclass(slots=True)
+class _DatasetGroup:
+    """Accumulator for the datasets merged into one entry by consolidate_datasets."""
+    dataset_name: str
+    primary_table: str
+    source_type: str
+    tables: set = dataclasses.field(default_factory=set)
+    joins: list = dataclasses.field(default_factory=list)
+    source_query: Optional[str] = None
+    dimensions: list = dataclasses.field(default_factory=list)
+    measures: list = dataclasses.field(default_factory=list)
+    seen_dim_exprs: set = dataclasses.field(default_factory=set)
+    seen_measure_exprs: set = dataclasses.field(default_factory=set)
+    seen_join_sources: set = dataclasses.field(default_factory=set)
+
+
 def consolidate_datasets(datasets_analysis: list[dict]) -> list[dict]:
     """
     Consolidate datasets that share the same primary source table into a single entry.
@@ -525,81 +864,80 @@ def consolidate_datasets(datasets_analysis: list[dict]) -> list[dict]:
     Returns:
         Consolidated list where each primary table appears only once
     """
-    # Group datasets by primary_table (or first table in tables[])
+    # Group datasets by primary_table (or first table in tables[]); primary
+    # table names repeat across datasets, so intern them to share one copy
+    intern = sys.intern
     groups = {}
     for ds in datasets_analysis:
-        primary = ds.get('primary_table', '')
+        ds_get = ds.get
+        primary = ds_get('primary_table', '')
         if not primary:
-            tables = ds.get('tables', [])
+            tables = ds_get('tables', [])
             primary = tables[0] if tables else ''
         
         if not primary:
             # Can't determine primary table — keep as standalone
-            primary = ds.get('dataset_name', f'unknown_{len(groups)}')
-        
-        primary_lower = primary.lower()
-        if primary_lower not in groups:
-            groups[primary_lower] = {
-                'dataset_name': ds.get('dataset_name', ''),
-                'primary_table': primary,
-                'tables': set(),
-                'joins': [],
-                'source_query': None,
-                'dimensions': [],
-                'measures': [],
-                'source_type': ds.get('source_type', 'single_table'),
-                '_seen_dim_exprs': set(),
-                '_seen_measure_exprs': set(),
-                '_seen_join_sources': set(),
-            }
+            primary = ds_get('dataset_name', f'unknown_{len(groups)}')
         
-        group = groups[primary_lower]
+        primary_lower = intern(primary.lower())
+        group = groups.get(primary_lower)
+        if group is None:
+            group = groups[primary_lower] = _DatasetGroup(
+                dataset_name=ds_get('dataset_name', ''),
+                primary_table=intern(primary),
+                source_type=ds_get('source_type', 'single_table')
+            )
         
         # Merge tables
-        for t in ds.get('tables', []):
-            group['tables'].add(t)
+        group.tables.update(ds_get('tables', ()))
         
         # Upgrade source_type to 'joined' if any entry is joined
-        if ds.get('source_type') == 'joined':
-            group['source_type'] = 'joined'
+        if ds_get('source_type') == 'joined':
+            group.source_type = 'joined'
         
         # Merge joins (deduplicate by join source table)
-        for join in ds.get('joins', []) or []:
+        seen_joins = group.seen_join_sources
+        add_join = group.joins.append
+        for join in ds_get('joins') or ():
             join_source = join.get('source', '').lower()
-            if join_source and join_source not in group['_seen_join_sources']:
-                group['_seen_join_sources'].add(join_source)
-                group['joins'].append(join)
+            if join_source and join_source not in seen_joins:
+                seen_joins.add(join_source)
+                add_join(join)
         
         # Keep source_query if present (for complex queries that can't use native joins)
-        if ds.get('source_query') and not group['source_query']:
-            group['source_query'] = ds['source_query']
+        if ds_get('source_query') and not group.source_query:
+            group.source_query = ds['source_query']
         
         # Merge dimensions (deduplicate by expr)
-        for dim in ds.get('dimensions', []):
-            expr_key = dim.get('expr', '').lower().strip()
-            if expr_key and expr_key not in group['_seen_dim_exprs']:
-                group['_seen_dim_exprs'].add(expr_key)
-                group['dimensions'].append(dim)
+        seen_dims = group.seen_dim_exprs
+        add_dim = group.dimensions.append
+        for dim in ds_get('dimensions', ()):
+            expr_key = _expr_key(dim.get('expr', ''))
+            if expr_key and expr_key not in seen_dims:
+                seen_dims.add(expr_key)
+                add_dim(dim)
         
         # Merge measures (deduplicate by expr)
-        for measure in ds.get('measures', []):
-            expr_key = measure.get('expr', '').lower().strip()
-            if expr_key and expr_key not in group['_seen_measure_exprs']:
-                group['_seen_measure_exprs'].add(expr_key)
-                group['measures'].append(measure)
+        seen_measures = group.seen_measure_exprs
+        add_measure = group.measures.append
+        for measure in ds_get('measures', ()):
+            expr_key = _expr_key(measure.get('expr', ''))
+            if expr_key and expr_key not in seen_measures:
+                seen_measures.add(expr_key)
+                add_measure(measure)
     
     # Build consolidated results
     consolidated = []
     for group in groups.values():
         entry = {
-            'dataset_name': group['dataset_name'],
-            'source_type': group['source_type'],
-            'primary_table': group['primary_table'],
-            'tables': sorted(group['tables']),
-            'joins': group['joins'] if group['joins'] else None,
-            'source_query': group['source_query'],
-            'dimensions': group['dimensions'],
-            'measures': group['measures'],
+            'dataset_name': group.dataset_name,
+            'source_type': group.source_type,
+            'primary_table': group.primary_table,
+            'tables': sorted(group.tables),
+            'joins': group.joins if group.joins else None,
+            'source_query': group.source_query,
+            'dimensions': group.dimensions,
+            'measures': group.measures,
         }
         consolidated.append(entry)
     
@@ -648,26 +986,34 @@ def validate_join_structure(joins: list[dict]) -> tuple[list[dict], list[dict]]:
         return joins, []
     
     fixes = []
-    top_level_names = {j.get('name', '') for j in joins}
+    top_level_names = {j.get('name', '') for j in joins} - {''}
+    if not top_level_names:
+        return joins, fixes
+    
+    # One alternation over all top-level names, compiled once per call
+    sibling_ref = re.compile(
+        r'(?<!\w)(' + '|'.join(map(re.escape, top_level_names)) + r')\.'
+    )
     
     # Find joins whose 'on' references a sibling (not 'source')
     to_nest = []
     for i, j in enumerate(joins):
         on_clause = j.get('on', '')
-        if not on_clause:
+        # A sibling reference needs dot notation; skip the regex otherwise
+        if not on_clause or '.' not in on_clause:
             continue
-        for sibling in top_level_names:
-            if sibling == j.get('name', ''):
+        join_name = j.get('name', '')
+        for match in sibling_ref.finditer(on_clause):
+            sibling = match.group(1)
+            if sibling == join_name:
                 continue
-            # Check if 'on' references this sibling join
-            if re.search(rf'(?<!\w){re.escape(sibling)}\.', on_clause):
-                to_nest.append((i, sibling))
-                fixes.append({
-                    'type': 'restructured_nested_join',
-                    'join': j.get('name', ''),
-                    'nested_under': sibling
-                })
-                break
+            to_nest.append((i, sibling))
+            fixes.append({
+                'type': 'restructured_nested_join',
+                'join': join_name,
+                'nested_under': sibling
+            })
+            break
     
     if not to_nest:
         return joins, fixes
@@ -714,18 +1060,27 @@ def fix_nested_join_references(
     
     fixes = []
     
+    # Match 'nested_name.col' but NOT if already preceded by parent chain
+    # Negative lookbehind: don't match if preceded by word char or dot
+    # One alternation over all nested names (longest first), compiled once per call
+    nested_ref = re.compile(
+        r'(?<![\w.])('
+        + '|'.join(map(re.escape, sorted(nested_joins, key=len, reverse=True)))
+        + r')\.'
+    )
+    
+    def to_full_chain(match):
+        return f'{nested_joins[match.group(1)]}.'
+    
     for field_list in [dimensions, measures]:
         for field in field_list:
             expr = field.get('expr', '')
+            # Every nested reference is 'name.col'; without a dot there is nothing to scan
+            if '.' not in expr:
+                continue
             original_expr = expr
             
-            for nested_name, full_chain in nested_joins.items():
-                # Match 'nested_name.col' but NOT if already preceded by parent chain
-                # Negative lookbehind: don't match if preceded by word char or dot
-                pattern = rf'(?<![\w.]){re.escape(nested_name)}\.'
-                replacement = f'{full_chain}.'
-                if re.search(pattern, expr):
-                    expr = re.sub(pattern, replacement, expr)
+            expr = nested_ref.sub(to_full_chain, expr)
             
             if expr != original_expr:
                 fixes.append({
@@ -739,6 +1094,37 @@ def fix_nested_join_references(
     return dimensions, measures, fixes
 
 
+def validate_and_fix_joins(
+    joins: list[dict],
+    dimensions: list[dict],
+    measures: list[dict]
+) -> tuple[list[dict], list[dict], list[dict], list[dict]]:
+    """Restructure flat joins that should be nested, then fix field references to nested joins.
+    
+    Combines validate_join_structure and fix_nested_join_references behind a
+    single check. The join chain map is only built when the restructured tree has
+    nested joins; for a flat tree every chain is just the join name and there is
+    nothing to rewrite.
+    
+    Args:
+        joins: List of top-level join dicts
+        dimensions: List of dimension dicts
+        measures: List of measure dicts
+    
+    Returns:
+        Tuple of (restructured joins, fixed dimensions, fixed measures, list of fixes applied)
+    """
+    if not joins:
+        return joins, dimensions, measures, []
+    joins, fixes = validate_join_structure(joins)
+    if any(j.get('joins') for j in joins):
+        dimensions, measures, ref_fixes = fix_nested_join_references(
+            dimensions, measures, build_join_chain_map(joins)
+        )
+        fixes.extend(ref_fixes)
+    return joins, dimensions, measures, fixes
+
+
 def validate_measure_references(measures: list[dict]) -> dict[str, str]:
     """Find MEASURE(x) references that have no corresponding base measure defined.
     
@@ -748,15 +1134,31 @@ def validate_measure_references(measures: list[dict]) -> dict[str, str]:
     Returns:
         Dict mapping missing base measure name to the derived measure that references it
     """
-    measure_names = {m['name'] for m in measures}
+    measure_names = frozenset(m['name'] for m in measures)
     missing = {}
+    find_refs = _MEASURE_REF_RE.findall
     for m in measures:
-        for ref in re.findall(r'MEASURE\((\w+)\)', m.get('expr', '')):
+        expr = m.get('expr')
+        # Most measures are plain aggregates; skip the regex unless a ref is possible
+        if not expr or 'MEASURE(' not in expr:
+            continue
+        for ref in find_refs(expr):
             if ref not in measure_names:
                 missing[ref] = m['name']
     return missing
 
 
+def _canonicalize_sql(sql: str) -> str:
+    """Normalize a dataset query so the same SQL always yields the same bytes.
+    
+    Drops a leading BOM, converts CRLF/CR line endings to LF and strips trailing
+    whitespace, so the SQL block in the repair prompts stays byte-identical across
+    runs and provider prefix caching keeps hitting.
+    """
+    sql = sql.lstrip('\ufeff').replace('\r\n', '\n').replace('\r', '\n')
+    return '\n'.join(line.rstrip() for line in sql.split('\n')).strip()
+
+
 def build_repair_prompt(missing_refs: dict[str, str], all_sql: str) -> str:
     """Build a focused LLM prompt to generate only the missing base window measures.
     
@@ -769,18 +1171,12 @@ def build_repair_prompt(missing_refs: dict[str, str], all_sql: str) -> str:
     """
     missing_list = '\n'.join(
         f'- {name} (referenced by derived measure: {derived})'
-        for name, derived in missing_refs.items()
+        for name, derived in sorted(missing_refs.items())
     )
+    # Stable content first (instructions, then the dashboard SQL) and the
+    # per-request list last, so repeated calls share a cacheable prompt prefix
     return f"""These base window measures are referenced by MEASURE() but were not defined.
-Generate ONLY the missing base window measures.
-
-Missing measures needed:
-{missing_list}
-
-Original SQL queries (find the OVER clauses that define these aliases):
-```sql
-{all_sql}
-```
+Generate ONLY the missing base window measures listed at the end.
 
 For each missing measure, return:
 - "name": the alias name
@@ -793,6 +1189,14 @@ Mapping for RANGE BETWEEN:
 - 27 PRECEDING AND CURRENT ROW = trailing 28 day
 - 90 PRECEDING AND CURRENT ROW = trailing 91 day
 
+Original SQL queries (find the OVER clauses that define these aliases):
+```sql
+{all_sql}
+```
+
+Missing measures needed:
+{missing_list}
+
 Return ONLY a JSON array of the missing measures, nothing else."""
 
 
@@ -811,29 +1215,109 @@ def build_semiadditive_prompt(
     """
     measures_list = '\n'.join(
         f'- {m["name"]} (expr: {m["expr"]}, range: {m["window"][0].get("range", "")})'
-        for m in measures_missing_semiadditive
+        for m in sorted(measures_missing_semiadditive, key=lambda m: m['name'])
     )
-    return f"""For each window measure below, determine the correct semiadditive value.
+    # Stable content first, per-request measure list last (see build_repair_prompt)
+    return f"""For each window measure listed at the end, determine the correct semiadditive value.
 
 semiadditive controls how the measure is summarized when the order dimension
 is NOT in the GROUP BY:
 - "last": use the last value in the window (typical for running totals, trailing sums, end-of-period snapshots)
 - "first": use the first value in the window (typical for opening balances, start-of-period values)
 
-Measures needing semiadditive:
-{measures_list}
+Return a JSON object mapping measure name to semiadditive value ("first" or "last").
+Example: {{"clicks_t28d": "last", "opening_balance": "first"}}
 
 Original SQL for context:
 ```sql
 {all_sql}
 ```
 
-Return a JSON object mapping measure name to semiadditive value ("first" or "last").
-Example: {{"clicks_t28d": "last", "opening_balance": "first"}}
+Measures needing semiadditive:
+{measures_list}
 
 Return ONLY the JSON object, nothing else."""
 
 
+def _measures_missing_semiadditive(consolidated: list[dict]) -> list[tuple[dict, list[dict]]]:
+    """(measure, windows lacking 'semiadditive') pairs for window measures across all datasets.
+    
+    Keeping the windows alongside each measure lets _apply_semiadditive patch
+    them without scanning every window again.
+    """
+    missing = []
+    for ds in consolidated:
+        for m in ds.get('measures', []):
+            missing_windows = [w for w in m.get('window') or () if 'semiadditive' not in w]
+            if missing_windows:
+                missing.append((m, missing_windows))
+    return missing
+
+
+def _request_semiadditive(
+    measures_missing_semi: list[tuple[dict, list[dict]]],
+    all_sql: str,
+    pat_token: str
+) -> Optional[dict]:
+    """Ask the LLM for the semiadditive value of each window measure.
+    
+    Args:
+        measures_missing_semi: (measure, missing windows) pairs from _measures_missing_semiadditive
+        all_sql: All original SQL queries concatenated
+        pat_token: Personal Access Token for LLM API calls
+    
+    Returns:
+        Dict mapping measure name to 'first'/'last', or None when there is no SQL
+        context or the call fails (callers then default to 'last')
+    """
+    if not all_sql:
+        return None
+    # Ask about each name once; the answer applies to every measure with it
+    unique_semi = {}
+    for m, _ in measures_missing_semi:
+        unique_semi.setdefault(m['name'], m)
+    semi_prompt = build_semiadditive_prompt(list(unique_semi.values()), all_sql)
+    try:
+        semi_map = _extract_json(call_foundation_model(semi_prompt, pat_token), '{')
+    except Exception:
+        semi_map = None
+    if not isinstance(semi_map, dict):
+        # Don't let a bad answer stick in the cache as a permanent fallback
+        _discard_llm_cache(semi_prompt)
+        return None
+    return semi_map
+
+
+def _apply_semiadditive(
+    measures_missing_semi: list[tuple[dict, list[dict]]],
+    semi_map: Optional[dict],
+    fixes: list[dict]
+) -> None:
+    """Set 'semiadditive' on every window that lacks it, recording each fix.
+    
+    Args:
+        measures_missing_semi: (measure, missing windows) pairs from _measures_missing_semiadditive
+        semi_map: LLM answers from _request_semiadditive, or None to default to 'last'
+        fixes: List the applied fixes are appended to
+    """
+    for m, missing_windows in measures_missing_semi:
+        if semi_map is None:
+            # Fallback: default to 'last' since semiadditive is required
+            value, fix_type = 'last', 'added_semiadditive_fallback'
+        else:
+            value = semi_map.get(m['name'], 'last')
+            if value not in ('first', 'last'):
+                value = 'last'
+            fix_type = 'added_semiadditive'
+        for w in missing_windows:
+            w['semiadditive'] = value
+            fixes.append({
+                'type': fix_type,
+                'measure': m.get('name', ''),
+                'value': value
+            })
+
+
 def validate_and_fix_analysis(
     consolidated: list[dict],
     dashboard_json: dict,
@@ -845,7 +1329,7 @@ def validate_and_fix_analysis(
       1. Restructure flat joins that should be nested
       2. Fix nested join field references (chained dot notation)
     
-    LLM repair calls (only when needed):
+    LLM repair calls (only when needed; each is one call covering all datasets):
       3. Generate missing base window measures for orphaned MEASURE() references
       4. Determine semiadditive values for window measures missing this required property
     
@@ -857,111 +1341,107 @@ def validate_and_fix_analysis(
     Returns:
         Tuple of (fixed consolidated datasets, list of all fixes applied)
     """
+    # Only MEASURE() references and window measures can need an LLM fix (and so
+    # the SQL context); a dashboard with neither those nor joins needs no fixes
+    needs_llm_fixes = any(
+        m.get('window') or 'MEASURE(' in (m.get('expr') or '')
+        for ds in consolidated for m in ds.get('measures', [])
+    )
+    if not needs_llm_fixes and not any(ds.get('joins') for ds in consolidated):
+        return consolidated, []
+    
     # Collect all non-filter dataset SQL queries for potential repair prompts
-    all_queries = []
-    for dataset in dashboard_json.get('datasets', []):
-        query = ''.join(dataset.get('queryLines', []))
-        if query and not is_filter_dataset(query):
-            all_queries.append(query)
-    all_sql = '\n\n'.join(all_queries)
+    all_sql = ''
+    if needs_llm_fixes:
+        all_sql = '\n\n'.join(
+            query
+            for dataset in dashboard_json.get('datasets', ())
+            if (query := _canonicalize_sql(''.join(dataset.get('queryLines', ()))))
+            and not is_filter_dataset(query)
+        )
     
     all_fixes = []
+    # (dataset, orphaned MEASURE() refs) pairs, repaired together in Fix 3
+    missing_by_ds = []
     
     for ds in consolidated:
         joins = ds.get('joins', []) or []
         dimensions = ds.get('dimensions', [])
         measures = ds.get('measures', [])
         
-        # Fix 1: Restructure flat joins that should be nested
-        if joins:
-            joins, join_fixes = validate_join_structure(joins)
-            if join_fixes:
-                ds['joins'] = joins
-                all_fixes.extend(join_fixes)
-        
+        # Fix 1: Restructure flat joins that should be nested, and
         # Fix 2: Fix nested join field references (chained dot notation)
         if joins:
-            chain_map = build_join_chain_map(joins)
-            dimensions, measures, ref_fixes = fix_nested_join_references(
-                dimensions, measures, chain_map
+            joins, dimensions, measures, join_fixes = validate_and_fix_joins(
+                joins, dimensions, measures
             )
+            ds['joins'] = joins
             ds['dimensions'] = dimensions
             ds['measures'] = measures
-            if ref_fixes:
-                all_fixes.extend(ref_fixes)
+            all_fixes.extend(join_fixes)
         
-        # Fix 3: Missing base window measures (LLM repair if needed)
         missing = validate_measure_references(measures)
-        if missing and all_sql:
-            repair_prompt = build_repair_prompt(missing, all_sql)
+        if missing:
+            missing_by_ds.append((ds, missing))
+    
+    all_missing = {}
+    for _, missing in missing_by_ds:
+        for name, derived in missing.items():
+            all_missing.setdefault(name, derived)
+    measures_missing_semi = _measures_missing_semiadditive(consolidated)
+    
+    # The Fix 3 and Fix 4 LLM calls are independent for the measures that exist
+    # now, so they are sent concurrently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        repair_future = None
+        if all_missing and all_sql:
+            repair_prompt = build_repair_prompt(all_missing, all_sql)
+            repair_future = executor.submit(call_foundation_model, repair_prompt, pat_token)
+        semi_future = None
+        if measures_missing_semi:
+            semi_future = executor.submit(
+                _request_semiadditive, measures_missing_semi, all_sql, pat_token
+            )
+        
+        # Fix 3: Missing base window measures (one LLM repair call for all datasets).
+        # A base measure is defined by its SQL alias, so one definition serves every
+        # dataset that references it.
+        if repair_future is not None:
             try:
-                repair_response = call_foundation_model(repair_prompt, pat_token)
-                json_match = re.search(r'\[[\s\S]*\]', repair_response)
-                if json_match:
-                    repaired = json.loads(json_match.group())
-                    # Insert base measures BEFORE existing measures
-                    ds['measures'] = repaired + measures
+                repaired = [(m['name'], m) for m in _extract_json(repair_future.result(), '[')]
+            except Exception:
+                repaired = None
+                _discard_llm_cache(repair_prompt)
+            
+            for ds, missing in missing_by_ds:
+                if repaired is None:
                     all_fixes.append({
-                        'type': 'repaired_missing_measures',
+                        'type': 'repair_failed',
                         'dataset': ds.get('dataset_name', ''),
-                        'added': [m['name'] for m in repaired]
+                        'missing': list(missing.keys())
                     })
-            except Exception:
+                    continue
+                added = [copy.deepcopy(m) for name, m in repaired if name in missing]
+                # Insert base measures BEFORE existing measures (in place, no list copy)
+                ds.setdefault('measures', [])[:0] = added
                 all_fixes.append({
-                    'type': 'repair_failed',
+                    'type': 'repaired_missing_measures',
                     'dataset': ds.get('dataset_name', ''),
-                    'missing': list(missing.keys())
+                    'added': [m['name'] for m in added]
                 })
         
         # Fix 4: Ensure all window measures have required 'semiadditive' property
-        # Re-read measures in case Fix 3 modified ds['measures']
-        measures = ds.get('measures', [])
-        measures_missing_semi = [
-            m for m in measures
-            if m.get('window') and any('semiadditive' not in w for w in m['window'])
-        ]
-        if measures_missing_semi:
-            if all_sql:
-                semi_prompt = build_semiadditive_prompt(measures_missing_semi, all_sql)
-                try:
-                    semi_response = call_foundation_model(semi_prompt, pat_token)
-                    semi_match = re.search(r'\{[\s\S]*\}', semi_response)
-                    if semi_match:
-                        semi_map = json.loads(semi_match.group())
-                        for m in measures_missing_semi:
-                            value = semi_map.get(m['name'], 'last')
-                            if value not in ('first', 'last'):
-                                value = 'last'
-                            for w in m.get('window', []):
-                                if 'semiadditive' not in w:
-                                    w['semiadditive'] = value
-                                    all_fixes.append({
-                                        'type': 'added_semiadditive',
-                                        'measure': m.get('name', ''),
-                                        'value': value
-                                    })
-                except Exception:
-                    # Fallback: default to 'last' since semiadditive is required
-                    for m in measures_missing_semi:
-                        for w in m.get('window', []):
-                            if 'semiadditive' not in w:
-                                w['semiadditive'] = 'last'
-                                all_fixes.append({
-                                    'type': 'added_semiadditive_fallback',
-                                    'measure': m.get('name', ''),
-                                    'value': 'last'
-                                })
-            else:
-                # No SQL context available, default to 'last'
-                for m in measures_missing_semi:
-                    for w in m.get('window', []):
-                        if 'semiadditive' not in w:
-                            w['semiadditive'] = 'last'
-                            all_fixes.append({
-                                'type': 'added_semiadditive_fallback',
-                                'measure': m.get('name', ''),
-                                'value': 'last'
-                            })
+        if semi_future is not None:
+            _apply_semiadditive(measures_missing_semi, semi_future.result(), all_fixes)
+    
+    # Measures added by Fix 3 may still lack semiadditive; ask once more for those
+    late_missing_semi = _measures_missing_semiadditive(consolidated)
+    if late_missing_semi:
+        _apply_semiadditive(
+            late_missing_semi,
+            _request_semiadditive(late_missing_semi, all_sql, pat_token),
+            all_fixes
+        )
     
     return consolidated, all_fixes
 
@@ -990,7 +1470,7 @@ def get_dashboard_definition(
     dashboard = w.lakeview.get(dashboard_id=dashboard_id)
     
     if dashboard.serialized_dashboard:
-        return json.loads(dashboard.serialized_dashboard)
+        return _json_loads(dashboard.serialized_dashboard)
     
     return {}
 
@@ -1007,7 +1487,7 @@ def extract_dashboard_metrics(
     This function orchestrates the full workflow:
     1. Fetch dashboard JSON
     2. Extract widget fields
-    3. Send to LLM for analysis
+    3. Send dataset groups to LLM for analysis (concurrently)
     4. Generate Metrics View SQL statements
     
     Args:
@@ -1038,30 +1518,26 @@ def extract_dashboard_metrics(
                 "status": "error"
             }
         
-        # Step 2: Build analysis prompt (includes extract_widget_fields)
-        analysis_prompt = build_analysis_prompt(dashboard_json, target_catalog_schema)
+        # Steps 2-3: Extract widget fields and call LLM to analyze dataset groups
+        llm_responses = analyze_dashboard(dashboard_json, target_catalog_schema, pat_token)
         
-        # Step 3: Call LLM to analyze dashboard structure
-        llm_response = call_foundation_model(analysis_prompt, pat_token)
-        
-        # Parse LLM response
-        try:
-            # Try to extract JSON from response (in case there's extra text)
-            json_match = re.search(r'\{[\s\S]*\}', llm_response)
-            if json_match:
-                analysis_result = json.loads(json_match.group())
-            else:
-                analysis_result = json.loads(llm_response)
-        except json.JSONDecodeError as e:
-            return {
-                "dashboard_id": dashboard_id,
-                "error": f"Failed to parse LLM response as JSON: {str(e)}",
-                "llm_response": llm_response[:1000],
-                "status": "error"
-            }
+        # Parse LLM responses
+        datasets_analysis = []
+        for llm_response in llm_responses:
+            try:
+                # Extract the JSON object from the response (in case there's extra text)
+                analysis_result = _extract_json(llm_response, '{')
+            except json.JSONDecodeError as e:
+                return {
+                    "dashboard_id": dashboard_id,
+                    "error": f"Failed to parse LLM response as JSON: {str(e)}",
+                    "llm_response": llm_response[:1000],
+                    "status": "error"
+                }
+            datasets_analysis.extend(analysis_result.get('datasets_analysis', []))
         
         # Step 4: Consolidate datasets sharing the same primary source table
-        datasets_analysis = analysis_result.get('datasets_analysis', [])
+        # (also merges entries produced by different dataset groups)
         consolidated = consolidate_datasets(datasets_analysis)
         
         # Step 4b: Validation layer - fix nested joins, field references, and missing measures
@@ -1232,4 +1708,46 @@ def extract_and_generate(
         JSON string with execution_steps and status
     """
     result = extract_dashboard_metrics(dashboard_id, target_catalog_schema, pat_token, host)
+    if orjson is not None:
+        return orjson.dumps(result, option=orjson.OPT_INDENT_2).decode()
     return json.dumps(result, indent=2)
+
+
+def process_dashboards(
+    dashboard_ids: list[str],
+    target_catalog_schema: str,
+    pat_token: str,
+    host: Optional[str] = None,
+    max_workers: int = DASHBOARD_MAX_WORKERS
+) -> dict[str, dict]:
+    """
+    Run extract_dashboard_metrics over several dashboards concurrently.
+    
+    Wall time is dominated by LLM calls, so overlapping dashboards gives a
+    near-linear speedup up to the endpoint's rate limit. LLM calls from all
+    dashboards share the LLM_MAX_CONCURRENT_CALLS limit. Each result is the
+    same dict extract_dashboard_metrics returns; a failing dashboard reports
+    its own error without affecting the others.
+    
+    Args:
+        dashboard_ids: The Databricks dashboard IDs to process
+        target_catalog_schema: Target catalog.schema where views will be created
+        pat_token: Personal Access Token for API calls
+        host: Optional Databricks host URL
+        max_workers: Maximum number of dashboards processed at once
+    
+    Returns:
+        dict mapping each dashboard ID to its result dict
+    """
+    dashboard_ids = list(dict.fromkeys(dashboard_ids))
+    if not dashboard_ids:
+        return {}
+    
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(dashboard_ids))) as executor:
+        results = executor.map(
+            lambda dashboard_id: extract_dashboard_metrics(
+                dashboard_id, target_catalog_schema, pat_token, host
+            ),
+            dashboard_ids
+        )
+        return dict(zip(dashboard_ids, results))
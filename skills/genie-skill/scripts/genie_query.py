@@ -5,16 +5,22 @@ Simple interface to interact with Databricks Genie API
 for natural language querying of data spaces.
 """
 
+import functools
+
 from databricks.sdk import WorkspaceClient
 from databricks.sdk.service.dashboards import GenieMessage
 from datetime import timedelta
 from typing import Optional
 
 
+@functools.lru_cache(maxsize=1)
 def get_workspace_client() -> WorkspaceClient:
     """
     Initialize and return a Databricks WorkspaceClient.
     
+    The client is created once and reused by later calls, so a series of
+    questions shares its authentication setup and HTTP connections.
+    
     Uses environment variables or .databrickscfg for authentication:
     - DATABRICKS_HOST
     - DATABRICKS_TOKEN (or other auth methods)
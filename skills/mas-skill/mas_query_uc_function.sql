@@ -12,6 +12,11 @@ AS $$
 import json
 import requests
 
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib json module
+    orjson = None
+
 DATABRICKS_HOST = "<INSERT_DATABRICKS_HOST>"
 MAS_ENDPOINT = "<INSERT_MAS_ENDPOINT_NAME>"
 
@@ -35,18 +40,15 @@ try:
     response = requests.post(url, headers=headers, json=payload, timeout=300)
     response.raise_for_status()
     
-    result_json = response.json()
+    result_json = orjson.loads(response.content) if orjson is not None else json.loads(response.content)
     
     # Extract text from response.output
-    texts = []
-    if "output" in result_json:
-        for output in result_json["output"]:
-            if "content" in output:
-                for content in output["content"]:
-                    if "text" in content:
-                        texts.append(content["text"])
-    
-    response_text = " ".join(texts)
+    response_text = " ".join(
+        content["text"]
+        for output in result_json.get("output", ())
+        for content in output.get("content", ())
+        if "text" in content
+    )
     
     result = json.dumps({
         "question": question,
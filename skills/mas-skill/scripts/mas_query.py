@@ -6,12 +6,37 @@ Query Databricks MAS serving endpoints using requests library.
 
 import requests
 import json
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 from typing import Optional
 
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib json module
+    orjson = None
+
 
 DATABRICKS_HOST = "<INSERT_DATABRICKS_HOST>"
 MAS_ENDPOINT = "<INSERT_MAS_ENDPOINT_NAME>"
 
+# Shared HTTP session: keeps connections alive across MAS queries and retries
+# gateway errors (502/503/504) and failed connection attempts with backoff.
+# read=0: a query that reached the agent is never re-sent after a read error
+# or timeout, since re-running it is not idempotent
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=3,
+        read=0,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False
+    )
+))
+
 
 def query_mas(
     question: str,
@@ -47,18 +72,16 @@ def query_mas(
         ]
     }
     
-    response = requests.post(url, headers=headers, json=payload)
+    response = _SESSION.post(url, headers=headers, json=payload)
     response.raise_for_status()
     
-    result = response.json()
+    # orjson parses the raw bytes directly; stdlib json decodes to str first
+    result = orjson.loads(response.content) if orjson is not None else json.loads(response.content)
     
     # Extract text from response.output
-    texts = []
-    if "output" in result:
-        for output in result["output"]:
-            if "content" in output:
-                for content in output["content"]:
-                    if "text" in content:
-                        texts.append(content["text"])
-    
-    return " ".join(texts)
+    return " ".join(
+        content["text"]
+        for output in result.get("output", ())
+        for content in output.get("content", ())
+        if "text" in content
+    )